@@ -377,6 +377,8 @@ def main(argv):
                     params['new_log_file']=False
                 if not 'use_c3d' in params.keys():
                     params['use_c3d']=False
+                if not 'skip_up_to_date' in params.keys():
+                    params['skip_up_to_date']=False
                 if not 'inputFolder' in params.keys():
                    print('\033[31mERROR! No input folder specified\033[0m',flush=True)
                    sys.exit()
@@ -432,6 +434,8 @@ def main(argv):
                     flags.append("--new_log")
                 if params['use_c3d']:
                     flags.append("--use_c3d")
+                if params['skip_up_to_date']:
+                    flags.append("--skip_up_to_date")
                 if not params['with-segmentation']:
                     flags.append("--no-segmentation")
                 if params['all-data-with-segmentation'] and params['with-segmentation']:
@@ -510,6 +514,8 @@ def main(argv):
                     params['multiprocessing']=1
                 if not 'log' in params.keys():
                     params['log']=''  
+                if not 'gpu' in params.keys():
+                    params['gpu']=False
 
                 if verbose:
                     print(f"\033[1m\n{params['function']}\033[0m",flush=True)                    
@@ -537,6 +543,8 @@ def main(argv):
                     flags.append("-v")  
                 if params['new_log_file']:
                     flags.append("--new_log") 
+                if params['gpu']:
+                    flags.append("--gpu")
                 if params['skip']!='':
                     flags.extend(["-S",str(params['skip'])])
                 if params['include']!='':
@@ -939,6 +947,18 @@ def main(argv):
                     params['skip']=''
                 if not 'include' in params.keys():
                     params['include']=''
+                if not 'itk_threads' in params.keys():
+                    params['itk_threads']=0
+                if not 'shrink_factor' in params.keys():
+                    params['shrink_factor']=1
+                if not 'max_iterations' in params.keys():
+                    params['max_iterations']=''
+                if not 'convergence_threshold' in params.keys():
+                    params['convergence_threshold']=''
+                if not 'bias_field_fwhm' in params.keys():
+                    params['bias_field_fwhm']=''
+                if not 'compression_level' in params.keys():
+                    params['compression_level']=6
  
                 if verbose:
                     print(f"\033[1m\n{params['function']}\033[0m",flush=True)                    
@@ -956,6 +976,17 @@ def main(argv):
                 flags.extend(["--corrected_img_name",str(params['corrected_image_filename'])])
                 flags.extend(["--bias_field_name",str(params['bias_field_image_filename'])])
                 flags.extend(["-e",str(params['suffix_name'])])
+                if params['shrink_factor']!=1:
+                    flags.extend(["--shrink_factor",str(params['shrink_factor'])])
+                if params['max_iterations']!='':
+                    flags.extend(["--max_iterations",str(params['max_iterations'])])
+                if params['convergence_threshold']!='':
+                    flags.extend(["--convergence_threshold",str(params['convergence_threshold'])])
+                if params['bias_field_fwhm']!='':
+                    flags.extend(["--bias_field_fwhm",str(params['bias_field_fwhm'])])
+                flags.extend(["--compression_level",str(params['compression_level'])])
+                if params['itk_threads']:
+                    flags.extend(["--itk_threads",str(params['itk_threads'])])
                 if params['verbose']:
                     flags.append("-v")
                 if params['new_log_file']:
@@ -12,6 +12,7 @@ setup(
     install_requires=[
         'torch>=2.1.2',
         'numpy<2',
+        'numba>=0.58',
         'pandas>2',
         'SimpleITK',
         'nibabel>=2.3.0',
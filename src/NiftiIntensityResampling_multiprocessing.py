@@ -28,6 +28,7 @@ The `INTENSITY_RESAMPLING` module supports the following options:
 - **skip**: Path to a file listing subfolders in `inputFolder` to exclude from processing.
 - **include**: Path to a file listing subfolders in `inputFolder` to include in processing (all subfolders are included by default).
 - **multiprocessing**: Specify the number of CPU cores to use for parallel processing.
+- **gpu**: Compute the resampling on the GPU with CuPy, falling back to the CPU if no GPU is available (default: False).
 - **suffix_name**: Suffix to add to the filename of the resampled image.
 
 Example Usage
@@ -83,21 +84,25 @@ In this example:
 #       --log <log file path>        Redirect stdout to a log file
 #       --new_log                    Overwrite existing log file if it exists
 #   -j, --n_jobs <number of jobs>    Number of simultaneous jobs (default: 1)
+#       --gpu                        Compute the resampling on the GPU with CuPy (default: False)
 #
 # Help:
 #     NiftiIntensityResampling_multiprocessing.py -h
 
 import sys, getopt, os
 from tqdm import tqdm
-import glob
 import multiprocessing
+import importlib.util
+from functools import partial
 import nibabel as nib
 import numpy as np
+import numba
 from datetime import datetime
 from utils import eprint
 from utils import hprint_msg_box
 from utils import hprint
 from utils import format_list_multiline
+from utils import list_subfolders
 
 def main(argv):
     inpath = ''
@@ -122,19 +127,20 @@ def main(argv):
     include_files=[]
     log = ''
     new_log = False
+    gpu = False
 
     try:
-        opts, args = getopt.getopt(argv, "h:vi:o:j:S:e:",["log=","new_log","n_jobs=","verbose","help","inputFolder=","outputFolder=","img_name=","msk_name=","resampled_img_name=","scale_min=","scale_max=","lower_bound=","upper_bound=","n_bins=","bin_width=","method=","skip=","include="])
+        opts, args = getopt.getopt(argv, "h:vi:o:j:S:e:",["log=","new_log","n_jobs=","verbose","help","inputFolder=","outputFolder=","img_name=","msk_name=","resampled_img_name=","scale_min=","scale_max=","lower_bound=","upper_bound=","n_bins=","bin_width=","method=","skip=","include=","gpu"])
     except getopt.GetoptError as err:
         print(f'Error: {err.msg}')
-        print('Usage: NiftiIntensityResampling_multiprocessing.py [-h|--help] [-v|--verbose] [-i|--inputFolder <inputfolder>] [-o|--outputFolder <outfolder>] [--img_name <image name>] [--resampled_img_name <resampled image name>] [-e <suffix>] [--scale_min <minimum scale>] [--scale_max <maximum scale>] [--lower_bound <lower percentile>] [--upper_bound <upper percentile>] [--n_bins <number of bins>] [--bin_width <bin width>] [--preset <window name>] [-S <skip file path>] [--include <include file path>] [--log <log file path>] [-j|--n_jobs <number of simultaneous jobs>]')
+        print('Usage: NiftiIntensityResampling_multiprocessing.py [-h|--help] [-v|--verbose] [-i|--inputFolder <inputfolder>] [-o|--outputFolder <outfolder>] [--img_name <image name>] [--resampled_img_name <resampled image name>] [-e <suffix>] [--scale_min <minimum scale>] [--scale_max <maximum scale>] [--lower_bound <lower percentile>] [--upper_bound <upper percentile>] [--n_bins <number of bins>] [--bin_width <bin width>] [--preset <window name>] [-S <skip file path>] [--include <include file path>] [--log <log file path>] [-j|--n_jobs <number of simultaneous jobs>] [--gpu]')
         sys.exit(2)
     for opt,arg in opts:
         if opt in ("-h", "--help"):
             print("NAME")
             print("\tNiftiIntensityResampling_multiprocessing.py\n")
             print("SYNOPSIS")
-            print("\tNiftiIntensityResampling_multiprocessing.py [-h|--help] [-v|--verbose] [-i|--inputFolder <inputfolder>] [-o|--outputFolder <outfolder>] [--img_name <image name>] [--resampled_img_name <resampled image name>] [-e <suffix>] [--scale_min <minimum scale>] [--scale_max <maximum scale>] [--lower_bound <lower percentile>] [--upper_bound <upper percentile>] [--n_bins <number of bins>] [--bin_width <bin width>] [--preset <window name>] [-S <skip file path>] [--include <include file path>] [--log <log file path>] [-j|--n_jobs <number of simultaneous jobs>]\n")
+            print("\tNiftiIntensityResampling_multiprocessing.py [-h|--help] [-v|--verbose] [-i|--inputFolder <inputfolder>] [-o|--outputFolder <outfolder>] [--img_name <image name>] [--resampled_img_name <resampled image name>] [-e <suffix>] [--scale_min <minimum scale>] [--scale_max <maximum scale>] [--lower_bound <lower percentile>] [--upper_bound <upper percentile>] [--n_bins <number of bins>] [--bin_width <bin width>] [--preset <window name>] [-S <skip file path>] [--include <include file path>] [--log <log file path>] [-j|--n_jobs <number of simultaneous jobs>] [--gpu]\n")
             print("DESCRIPTION")
             print("\tResample voxel intensity of Nifti images")
             print("OPTIONS")
@@ -157,6 +163,7 @@ def main(argv):
             print("\t --log: stdout redirect to log file")
             print("\t --new_log: overwrite previous log file")
             print("\t -j, --n_jobs: number of simultaneous jobs (default: 1)")
+            print("\t --gpu: compute the resampling on the GPU with CuPy (default: False)")
             sys.exit(0)
         elif opt in ("-i", "--inputFolder"):
             inpath = arg
@@ -196,6 +203,8 @@ def main(argv):
             msk=arg
         elif opt in ("-e"):
             suffix= arg
+        elif opt in ("--gpu"):
+            gpu= True
     
     if log != '':
         if new_log:
@@ -231,8 +240,34 @@ def main(argv):
     if inpath == '':
         print("\033[31mERROR! No input folder specify\033[0m",flush=True)
         sys.exit()
+
+    if not os.path.isdir(inpath):
+        print(f"\033[31mERROR! Input folder {inpath} not found\033[0m",flush=True)
+        sys.exit()
     
     
+    if method.lower() not in RESAMPLING_METHODS:
+        print(f"\033[31mERROR: Method '{method}' is not recognized\033[0m", flush=True)
+        sys.exit(2)
+
+    # resolve the method once, workers only apply it
+    resampling_method = RESAMPLING_METHODS[method.lower()]
+    if gpu:
+        if importlib.util.find_spec("cupy") is None:
+            print("\033[33mWARNING! No GPU available (CuPy is not installed), using CPU\033[0m",flush=True)
+            gpu = False
+        else:
+            resampling_method = partial(_resampling_gpu, method=method.lower())
+
+    params = {
+        'n_bins': int(n_bins),
+        'bin_width': bin_width,
+        'scale_min': scale_min,
+        'scale_max': scale_max,
+        'lower_bound': lower_bound,
+        'upper_bound': upper_bound,
+        }
+
     if suffix != '':
         r_img=os.path.splitext(os.path.splitext(os.path.basename(img))[0])[0]+"_"+suffix+".nii.gz"
     
@@ -262,6 +297,7 @@ def main(argv):
                 )
         msg += (
             f"n_jobs: {n_jobs}\n"
+            f"GPU: {gpu}\n"
             f"Skip file: {skip_file_name}\n"
             f"Files to skip: {format_list_multiline(skip_files,5)}\n"
             f"Include file: {include_file_name}\n"
@@ -274,28 +310,49 @@ def main(argv):
         hprint_msg_box(msg=msg, indent=2, title=f"INTENSITY_RESAMPLING {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
 
-    if n_jobs == 1:
-        for patient in tqdm(glob.glob(inpath+"/*"),
+    # constant-time membership tests in the workers (the lists are only kept for the verbose output)
+    skip_files = frozenset(skip_files)
+    include_files = frozenset(include_files)
+
+    # kept as a list: the progress bar needs the number of patients
+    patients = list_subfolders(inpath)
+    # same arguments for every patient, bound once
+    task = partial(resampling,inpath=inpath,outpath=outpath,img_name=img,r_img_name=r_img,msk_name=msk,method=method,resampling_method=resampling_method,params=params,dif_path=dif_path,skip_files=skip_files,include_files=include_files,verbose=verbose)
+
+    if n_jobs == 1 or len(patients) <= 1:
+        for patient in tqdm(patients,
                         ncols=100,
                         desc="Intensity Resampling",
                         bar_format="{l_bar}{bar} [time left: {remaining}, time spent: {elapsed}]",
                         colour="yellow"):
-            resampling(patient,inpath,outpath,img,r_img,msk,method,scale_min,scale_max,lower_bound,upper_bound,n_bins,bin_width,dif_path,skip_files,include_files,verbose,log)
+            task(patient)
     else:    
-        with multiprocessing.Pool(n_jobs) as pool:
-            tqdm(pool.starmap(resampling,
-                              [(patient,inpath,outpath,img,r_img,msk,method,scale_min,scale_max,lower_bound,upper_bound,n_bins,bin_width,dif_path,skip_files,include_files,verbose,log) for patient in glob.glob(inpath+"/*")]),
+        # largest patients first, handed out one at a time to the first free worker (LPT scheduling),
+        # so that a few large patients do not end up last and keep a single worker busy
+        patients.sort(key=lambda patient: _patient_size(patient, img), reverse=True)
+        # share the Numba threads between the workers instead of starting all of them in each worker
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(max(1, numba.config.NUMBA_NUM_THREADS // n_jobs), log)) as pool:
+            for _ in tqdm(pool.imap_unordered(task, patients),
+                          total=len(patients),
                           ncols=100,
                           desc="Intensity Resampling",
                           bar_format="{l_bar}{bar} [time left: {remaining}, time spent: {elapsed}]",
-                          colour="yellow")
+                          colour="yellow"):
+                pass
 
 
-def resampling(patient,inpath,outpath,img_name,r_img_name,msk_name,method,scale_min,scale_max,lower_bound,upper_bound,n_bins,bin_width,dif_path,skip_files,include_files,verbose,log):
-    if log != '':
-        f = open(log,'a+')
-        sys.stdout = f
-        
+def _patient_size(patient, img_name):
+    """Return the total size on disk of the images of a patient, as an estimate of its processing time."""
+    size = 0
+    for patient_subdirectory in list_subfolders(patient):
+        try:
+            size += os.path.getsize(os.path.join(patient_subdirectory, img_name))
+        except OSError:
+            pass
+    return size
+
+
+def resampling(patient,inpath,outpath,img_name,r_img_name,msk_name,method,resampling_method,params,dif_path,skip_files,include_files,verbose):
     patientID=os.path.basename(patient)
     
     if len(include_files) > 0: #if file to include are specify
@@ -314,21 +371,23 @@ def resampling(patient,inpath,outpath,img_name,r_img_name,msk_name,method,scale_
         hprint(f"processing {patientID}",patient)
 
    
-    if not os.path.exists(os.path.join(outpath,patientID)):
-       os.makedirs(os.path.join(outpath,patientID))
+    os.makedirs(os.path.join(outpath,patientID), exist_ok=True)
    
-    for patient_subdirectory in glob.glob(patient+"/*"):
+    # masks shared between subdirectories (symbolic or hard links to the same file) are read once
+    mask_cache = {}
+
+    for patient_subdirectory in list_subfolders(patient):
        subdirectory=os.path.basename(patient_subdirectory)
        if verbose:
            print(f"{patientID}: {subdirectory}", flush=True)
        
-       if not os.path.exists(os.path.join(outpath,patientID,subdirectory)):
-           os.makedirs(os.path.join(outpath,patientID,subdirectory))
+       os.makedirs(os.path.join(outpath,patientID,subdirectory), exist_ok=True)
        
        try: 
            # Load the NIfTI image
            img = nib.load(os.path.join(patient_subdirectory,img_name))
-           img_data = img.get_fdata()
+           # native on-disk data (memory-mapped when possible), converted to float32 slab by slab
+           img_data = np.asanyarray(img.dataobj)
        except FileNotFoundError:
             print(f"\033[31mERROR reading image {os.path.join(patient_subdirectory, img_name)}\033[0m", flush=True)
             print("\033[31mSkipping image "+patientID+" "+subdirectory+"\033[0m",flush=True)
@@ -343,9 +402,18 @@ def resampling(patient,inpath,outpath,img_name,r_img_name,msk_name,method,scale_
        if msk_name != '':
            try:
                #Load mask image
-               msk = nib.load(os.path.join(patient_subdirectory,msk_name))
-               msk_data = msk.get_fdata()
-               img_data_masked = img_data[msk_data > 0]
+               msk_path = os.path.join(patient_subdirectory,msk_name)
+               msk_stat = os.stat(msk_path)
+               msk_key = (msk_stat.st_dev, msk_stat.st_ino)
+               if msk_key in mask_cache:
+                   msk_data = mask_cache[msk_key]
+               else:
+                   msk = nib.load(msk_path)
+                   msk_data = _mask_to_bool(np.asanyarray(msk.dataobj))
+                   if os.path.islink(msk_path) or msk_stat.st_nlink > 1:
+                       mask_cache[msk_key] = msk_data
+               if msk_data.shape != img_data.shape:
+                   raise ValueError(f"mask shape {msk_data.shape} does not match image shape {img_data.shape}")
            except FileNotFoundError:
                 print(f"\033[31mERROR reading mask {os.path.join(patient_subdirectory, msk_name)}\033[0m", flush=True)
                 print("\033[31mSkipping mask"+patientID+" "+subdirectory+"\033[0m",flush=True)
@@ -357,71 +425,247 @@ def resampling(patient,inpath,outpath,img_name,r_img_name,msk_name,method,scale_
                 eprint("Skipping "+patientID+" "+subdirectory+" (ERROR reading mask)")
                 continue
        else:
-           img_data_masked=img_data
+           msk_data=None
         
         
-       bin_edges=np.array([]) 
-       r_img_data = np.copy(img_data)
-
        try:
-           if method.lower() == 'binning_number':
-               min_value = img_data_masked.min()
-               max_value = img_data_masked.max()
-               bin_edges = np.linspace(min_value, max_value, int(n_bins) + 1)
-               r_img_data = np.digitize(img_data, bin_edges) - 1
-               r_img_data = np.clip(r_img_data, 0, int(n_bins) - 1)
-
-           elif method.lower() == 'binning_number_v2':
-               min_value = img_data_masked.min()
-               max_value = img_data_masked.max()
-               r_img_data = ((img_data - min_value)/(max_value - min_value))*255
-               r_img_data = r_img_data.astype(np.uint8)
-               
-           elif method.lower() == 'binning_width':
-               min_value, max_value = img_data_masked.min(), img_data_masked.max()
-               bin_edges = np.arange(min_value, max_value + bin_width, bin_width)
-               r_img_data = np.digitize(img_data_masked, bin_edges) - 1
-               min_value = img_data_masked.min()
-               max_value = img_data_masked.max()
-               bin_edges = np.arange(min_value, max_value + bin_width, bin_width)
-               r_img_data = np.digitize(img_data, bin_edges) - 1
-               r_img_data = np.clip(r_img_data, 0, len(bin_edges) - 2)
-
-           elif method.lower() == 'linear_scaling':
-                min_value = img_data_masked.min()
-                max_value = img_data_masked.max()
-                r_img_data = ((img_data - min_value) / (max_value - min_value)) * (scale_max - scale_min) + scale_min
-
-
-           elif method.lower() == 'zscore_normalization':
-               mean = img_data_masked.mean()
-               std_dev = img_data_masked.std()
-               r_img_data = (img_data - mean) / std_dev 
-
-           elif method.lower() == 'robust_scaling':
-                median = np.median(img_data_masked)
-                p1 = np.percentile(img_data_masked, lower_bound)
-                p2 = np.percentile(img_data_masked, upper_bound)
-                r_img_data = (img_data - median) / (p2 - p1)
-
-           else:
-                print(f"\033[31mERROR: Method '{method}' is not recognized\033[0m", flush=True)
-                sys.exit(2)
-
+           r_img_data = resampling_method(img_data, msk_data, params)
        except Exception as e:
             print(f"\033[31mERROR computing intensity resampling with method '{method}' for image '{os.path.join(patient_subdirectory, img_name)}':\033[0m {e}", flush=True)
             print("\033[31mSkipping"+patientID+" "+subdirectory+"\033[0m",flush=True)
             eprint("Skipping "+patientID+" "+subdirectory+" (ERROR computing intensity resampling)")
             continue            
        try:
-            # Create a new NIfTI image with the modified data
-            r_img=nib.Nifti1Image(r_img_data,affine=img.affine,header=img.header)
+            # Create a new NIfTI image with the modified data, stored unscaled in its own dtype
+            # (small unsigned integers for the binning methods, float32 for the scaling methods).
+            # NIfTI data is written in Fortran order, the layout of the method outputs, so
+            # asfortranarray is a no-op and nibabel writes the array without reordering it.
+            r_hdr = img.header.copy()
+            r_hdr.set_data_dtype(r_img_data.dtype)
+            r_hdr.set_slope_inter(1.0, 0.0)
+            r_img=nib.Nifti1Image(np.asfortranarray(r_img_data),affine=img.affine,header=r_hdr)
             nib.save(r_img,os.path.join(outpath,patientID,subdirectory,r_img_name))
             if verbose:
                 hprint("Resampled image saved ",os.path.join(patient_subdirectory, r_img_name))
        except Exception as e:
             print(f"\033[31mERROR writing {os.path.join(patient_subdirectory, r_img_name)}:\033[0m {e}", flush=True)           
 
+# number of voxels processed at once when streaming a volume (16 MB of float32)
+SLAB_VOXELS = 4 * 1024 * 1024
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _stats(a):
+    """Return the minimum, maximum, sum, sum of squares and number of values of a non-empty 1D array
+    in a single pass."""
+    mn = np.float64(a[0])
+    mx = np.float64(a[0])
+    s = 0.0
+    ss = 0.0
+    for i in numba.prange(a.size):
+        v = np.float64(a[i])
+        mn = min(mn, v)
+        mx = max(mx, v)
+        s += v
+        ss += v * v
+    return mn, mx, s, ss, a.size
+
+@numba.njit(parallel=True, cache=True)
+def _masked_stats(a, m):
+    """Return the minimum, maximum, sum, sum of squares and number of values of `a` where the boolean
+    mask `m` is set, without extracting the masked values."""
+    mn = np.inf
+    mx = -np.inf
+    s = 0.0
+    ss = 0.0
+    n = 0
+    for i in numba.prange(a.size):
+        if m[i]:
+            v = np.float64(a[i])
+            mn = min(mn, v)
+            mx = max(mx, v)
+            s += v
+            ss += v * v
+            n += 1
+    return mn, mx, s, ss, n
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _affine(src, dst, a, b):
+    """Write `src * a + b` into `dst` in a single pass, without temporary arrays."""
+    for i in numba.prange(src.size):
+        dst[i] = src[i] * a + b
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _bin(src, dst, min_value, inv_step, max_bin):
+    """Write the index of the uniform bin of `src` values, clipped to [0, max_bin], into `dst`."""
+    for i in numba.prange(src.size):
+        dst[i] = min(max(int((src[i] - min_value) * inv_step), 0), max_bin)
+
+# The kernels are compiled on first use (or loaded from the on-disk cache). They are not
+# called at import: running a parallel kernel starts Numba's thread pool, which must not
+# exist yet when multiprocessing forks the workers (TBB hangs, GNU OpenMP aborts).
+# Pool workers compile them once at startup in _init_worker.
+
+def _init_worker(n_threads, log):
+    """Pool initializer: redirect stdout to the log file, limit the Numba threads of the worker and
+    compile the kernels before the first task."""
+    if log != '':
+        # opened once per worker, line buffered so that messages of the workers are not interleaved mid-line
+        sys.stdout = open(log,'a+',buffering=1)
+    numba.set_num_threads(n_threads)
+    src = np.zeros(1, dtype=np.float32)
+    _stats(src)
+    _masked_stats(src, np.ones(1, dtype=np.bool_))
+    _affine(src, np.zeros(1, dtype=np.float32), 1.0, 0.0)
+    _bin(src, np.zeros(1, dtype=np.uint8), 0.0, 1.0, 0)
+
+def _mask_to_bool(msk_data):
+    """Return the mask as a boolean array (mask > 0), reinterpreting binary uint8 masks in place
+    instead of comparing and allocating a new array."""
+    if msk_data.dtype == np.bool_:
+        return msk_data
+    if msk_data.dtype == np.uint8 and msk_data.size > 0 and msk_data.max() <= 1:
+        return msk_data.view(np.bool_)
+    return msk_data > 0
+
+def _slabs(shape):
+    """Yield the index of consecutive slabs of about SLAB_VOXELS voxels along the last axis."""
+    thickness = max(1, SLAB_VOXELS // max(1, int(np.prod(shape[:-1]))))
+    for z in range(0, shape[-1], thickness):
+        yield (Ellipsis, slice(z, min(z + thickness, shape[-1])))
+
+def _map_slabs(img_data, dtype, fn):
+    """Return a new array of the given dtype filled slab by slab with fn(src, dst), where src is a
+    float32 slab of the image and dst the matching slab of the output, both flattened in NIfTI
+    (Fortran) order."""
+    r_img_data = np.empty(img_data.shape, dtype=dtype, order='F')
+    for slab in _slabs(img_data.shape):
+        # slabs along the last axis of a Fortran-ordered array are contiguous: dst is a view
+        fn(np.ravel(img_data[slab], order='F').astype(np.float32, copy=False), np.ravel(r_img_data[slab], order='F'))
+    return r_img_data
+
+def _intensity_stats(img_data, msk_data):
+    """Return the minimum, maximum, mean and standard deviation of the image, in the mask if any,
+    reading the image slab by slab."""
+    mn, mx, s, ss, n = np.inf, -np.inf, 0.0, 0.0, 0
+    for slab in _slabs(img_data.shape):
+        src = np.ravel(img_data[slab], order='F').astype(np.float32, copy=False)
+        if msk_data is None:
+            slab_stats = _stats(src)
+        else:
+            slab_stats = _masked_stats(src, np.ravel(msk_data[slab], order='F'))
+        mn, mx = min(mn, slab_stats[0]), max(mx, slab_stats[1])
+        s, ss, n = s + slab_stats[2], ss + slab_stats[3], n + slab_stats[4]
+    if n == 0:
+        raise ValueError("no voxel to compute the intensity statistics (empty mask)")
+    mean = s / n
+    return mn, mx, mean, np.sqrt(max(ss / n - mean * mean, 0.0))
+
+def _bin_dtype(n_bins):
+    """Return the smallest unsigned integer dtype holding n_bins bin indices."""
+    if n_bins <= 256:
+        return np.uint8
+    if n_bins <= 65536:
+        return np.uint16
+    return np.uint32
+
+def _binning_number(img_data, msk_data, params):
+    """Fixed number of bins."""
+    min_value, max_value, _, _ = _intensity_stats(img_data, msk_data)
+    # bins are uniform: compute the bin index directly instead of a binary search with np.digitize
+    step = (max_value - min_value) / params['n_bins']
+    if step == 0:
+        step = 1.0
+    return _map_slabs(img_data, _bin_dtype(params['n_bins']), lambda src, dst: _bin(src, dst, min_value, 1.0 / step, params['n_bins'] - 1))
+
+def _binning_number_v2(img_data, msk_data, params):
+    """256 bins, computed in uint8."""
+    min_value, max_value, _, _ = _intensity_stats(img_data, msk_data)
+    return _map_slabs(img_data, np.uint8, lambda src, dst: _bin(src, dst, min_value, 255 / (max_value - min_value), 255))
+
+def _binning_width(img_data, msk_data, params):
+    """Fixed bin width."""
+    min_value, max_value, _, _ = _intensity_stats(img_data, msk_data)
+    n_width_bins = max(int(np.ceil((max_value - min_value) / params['bin_width'])), 1)
+    return _map_slabs(img_data, _bin_dtype(n_width_bins), lambda src, dst: _bin(src, dst, min_value, 1.0 / params['bin_width'], n_width_bins - 1))
+
+def _linear_scaling(img_data, msk_data, params):
+    """Linear scaling between scale_min and scale_max."""
+    min_value, max_value, _, _ = _intensity_stats(img_data, msk_data)
+    a = (params['scale_max'] - params['scale_min']) / (max_value - min_value)
+    b = params['scale_min'] - min_value * a
+    return _map_slabs(img_data, np.float32, lambda src, dst: _affine(src, dst, a, b))
+
+def _zscore_normalization(img_data, msk_data, params):
+    """Z-score normalization."""
+    _, _, mean, std_dev = _intensity_stats(img_data, msk_data)
+    return _map_slabs(img_data, np.float32, lambda src, dst: _affine(src, dst, 1.0 / std_dev, -mean / std_dev))
+
+def _percentiles(values, percentiles):
+    """Return the percentiles of a 1D array with linear interpolation (as np.percentile), from a single
+    in-place np.partition of `values` on the order statistics they need."""
+    if values.size == 0:
+        raise ValueError("no voxel to compute the percentiles (empty mask)")
+    positions = [p / 100.0 * (values.size - 1) for p in percentiles]
+    lows = [int(np.floor(x)) for x in positions]
+    highs = [min(k + 1, values.size - 1) for k in lows]
+    values.partition(sorted(set(lows + highs)))
+    return [float(values[lo]) + (float(values[hi]) - float(values[lo])) * (x - lo) for x, lo, hi in zip(positions, lows, highs)]
+
+def _robust_scaling(img_data, msk_data, params):
+    """Centering on the median and scaling by the range between the lower and upper percentiles."""
+    # percentiles need the masked voxels themselves, in a copy that can be partitioned in place
+    if msk_data is None:
+        img_data_masked = np.array(np.ravel(img_data, order='K'))
+    else:
+        img_data_masked = img_data[msk_data]
+    median, p1, p2 = _percentiles(img_data_masked, [50, params['lower_bound'], params['upper_bound']])
+    return _map_slabs(img_data, np.float32, lambda src, dst: _affine(src, dst, 1.0 / (p2 - p1), -median / (p2 - p1)))
+
+def _resampling_gpu(img_data, msk_data, params, method):
+    """Apply a resampling method on the GPU with CuPy, on the whole volume at once.
+    Falls back to the CPU version of the method if no GPU can be used."""
+    import cupy as cp
+    try:
+        data = cp.asarray(img_data, dtype=cp.float32, order='F')
+    except cp.cuda.runtime.CUDARuntimeError:
+        print("No GPU available, trying with CPU.", flush=True)
+        return RESAMPLING_METHODS[method](img_data, msk_data, params)
+    values = data if msk_data is None else data[cp.asarray(msk_data, order='F')]
+    if values.size == 0:
+        raise ValueError("no voxel to compute the intensity statistics (empty mask)")
+
+    if method == 'robust_scaling':
+        median, p1, p2 = cp.percentile(values, cp.asarray([50, params['lower_bound'], params['upper_bound']])).tolist()
+        r_img_data = (data - median) * (1.0 / (p2 - p1))
+    elif method == 'zscore_normalization':
+        mean, std_dev = float(values.mean()), float(values.std())
+        r_img_data = (data - mean) * (1.0 / std_dev)
+    else:
+        min_value, max_value = float(values.min()), float(values.max())
+        if method == 'linear_scaling':
+            a = (params['scale_max'] - params['scale_min']) / (max_value - min_value)
+            r_img_data = data * a + (params['scale_min'] - min_value * a)
+        else:
+            if method == 'binning_number':
+                step = (max_value - min_value) / params['n_bins']
+                inv_step, n = 1.0 / (step if step != 0 else 1.0), params['n_bins']
+            elif method == 'binning_number_v2':
+                inv_step, n = 255 / (max_value - min_value), 256
+            else:
+                inv_step = 1.0 / params['bin_width']
+                n = max(int(np.ceil((max_value - min_value) / params['bin_width'])), 1)
+            r_img_data = cp.clip(((data - min_value) * inv_step).astype(cp.int32), 0, n - 1).astype(_bin_dtype(n))
+    return cp.asnumpy(r_img_data, order='F')
+
+RESAMPLING_METHODS = {
+    'binning_number': _binning_number,
+    'binning_number_v2': _binning_number_v2,
+    'binning_width': _binning_width,
+    'linear_scaling': _linear_scaling,
+    'zscore_normalization': _zscore_normalization,
+    'robust_scaling': _robust_scaling,
+    }
+
 def ordinal_suffix(n):
     if 11 <= n % 100 <= 13:
         suffix = 'th'
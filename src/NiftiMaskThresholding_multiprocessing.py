@@ -78,17 +78,26 @@ In this example:
 #     NiftiMaskThresholding_multiprocessing.py -h
 
 import sys, getopt, os
-import glob
+import math
+# thresholding makes no BLAS or OpenMP calls: do not let numpy's libraries start a thread per core
+# in the main process and in each worker
+for _var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+    os.environ.setdefault(_var, "1")
 import multiprocessing
+from functools import partial
 from tqdm import tqdm
 from datetime import datetime
-import shutil
 import nibabel as nib
 import numpy as np
+import numba
 from utils import eprint
 from utils import hprint_msg_box
 from utils import hprint
 from utils import format_list_multiline
+from utils import available_cores
+from utils import copy_file
+from utils import list_subfolders
+from utils import save_nifti
 
 def main(argv):
     inpath = ''
@@ -183,6 +192,13 @@ def main(argv):
             include_files = file.read().splitlines() 
         except:
             print("\033[31mERROR! Unable to read the include file\033[0m",flush=True) 
+    
+    try:
+        min_thr=float(min_thr)
+        max_thr=float(max_thr)
+    except ValueError:
+        print("\033[31mERROR! min_thr and max_thr must be numbers\033[0m",flush=True)
+        sys.exit(2)
         
     if outpath =='':
         outpath = inpath
@@ -197,6 +213,18 @@ def main(argv):
     if inpath == '':
         print("\033[31mERROR! No input folder specify\033[0m",flush=True)
         sys.exit()
+
+    if not os.path.isdir(inpath):
+        print(f"\033[31mERROR! Input folder {inpath} not found\033[0m",flush=True)
+        sys.exit()
+    
+    #more jobs than cores only adds context switches to a memory-bound task
+    max_jobs = available_cores()
+    if n_jobs > max_jobs:
+        if verbose:
+            print(f"\033[33mWARNING! n_jobs ({n_jobs}) is larger than the number of available CPU cores, using {max_jobs} jobs\033[0m",flush=True)
+        n_jobs = max_jobs
+    n_jobs = max(1, n_jobs)
         
     if verbose:
         msg =(
@@ -219,26 +247,39 @@ def main(argv):
         hprint_msg_box(msg=msg, indent=2, title=f"MASK THRESHOLDING {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         
         
-    if n_jobs == 1:
-        for patient in tqdm(glob.glob(inpath+"/*"),
+    # constant-time membership tests in the workers (the lists are only kept for the verbose output)
+    skip_files = frozenset(skip_files)
+    include_files = frozenset(include_files)
+
+    # kept as a list: the progress bar needs the number of patients
+    patients = list_subfolders(inpath)
+    # thresholds converted once to float32, for all patients
+    lo, hi = _float32_bounds(min_thr, max_thr)
+    # same output name for every mask, computed once
+    output_mask_name=os.path.splitext(os.path.splitext(os.path.basename(mask_name))[0])[0]+"_"+suffix+".nii.gz"
+    # same arguments for every patient, bound once
+    task = partial(crop_volume,inpath=inpath,outpath=outpath,lo=lo,hi=hi,img_name=img_name,mask_name=mask_name,output_mask_name=output_mask_name,skip_files=skip_files,include_files=include_files,dif_path=dif_path,verbose=verbose)
+
+    if n_jobs == 1 or len(patients) <= 1:
+        for patient in tqdm(patients,
                         ncols=100,
                         desc="Masks Thresholding",
                         bar_format="{l_bar}{bar} [time left: {remaining}, time spent: {elapsed}]",
                         colour="yellow"):
-            crop_volume(patient,inpath,outpath,min_thr,max_thr,img_name,mask_name,suffix,skip_files,include_files,dif_path,verbose,log)
+            task(patient)
     else:    
-        with multiprocessing.Pool(n_jobs) as pool:
-            tqdm(pool.starmap(crop_volume,
-                              [(patient,inpath,outpath,min_thr,max_thr,img_name,mask_name,suffix,skip_files,include_files,dif_path,verbose,log) for patient in glob.glob(inpath+"/*")]),
+        # share the Numba threads between the workers instead of starting all of them in each worker
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(max(1, numba.config.NUMBA_NUM_THREADS // n_jobs), log, task)) as pool:
+            # the task and its arguments reach each worker once, through the initializer: only patient paths are sent per chunk
+            for _ in tqdm(pool.imap_unordered(_run_task, patients, chunksize=max(1, len(patients)//(4*n_jobs))),
+                          total=len(patients),
                           ncols=100,
                           desc="Masks Thresholding",
                           bar_format="{l_bar}{bar} [time left: {remaining}, time spent: {elapsed}]",
-                          colour="yellow")
+                          colour="yellow"):
+                pass
 
-def crop_volume(patient,inpath,outpath,min_thr,max_thr,img_name,mask_name,suffix,skip_files,include_files,dif_path,verbose,log):
-    if log != '':
-        f = open(log,'a+')
-        sys.stdout = f
+def crop_volume(patient,inpath,outpath,lo,hi,img_name,mask_name,output_mask_name,skip_files,include_files,dif_path,verbose):
     patientID=os.path.basename(patient)
 
     if len(include_files) > 0: #if file to include are specify
@@ -253,33 +294,29 @@ def crop_volume(patient,inpath,outpath,min_thr,max_thr,img_name,mask_name,suffix
                  print("\033[33mWARNING\nskip "+patientID+" ("+patient+")\033[0m",flush=True)
              return
     
-    
-    output_mask_name=os.path.splitext(os.path.splitext(os.path.basename(mask_name))[0])[0]+"_"+suffix+".nii.gz"
-
-    
     if verbose:
         hprint(f"processing {patientID}",patient)
-    if not os.path.exists(os.path.join(outpath,patientID)):
-       os.makedirs(os.path.join(outpath,patientID))
+    os.makedirs(os.path.join(outpath,patientID), exist_ok=True)
    
-    for patient_subdirectory in glob.glob(patient+"/*"):
+    for patient_subdirectory in list_subfolders(patient):
        subdirectory=os.path.basename(patient_subdirectory)
        if verbose:
            print(patientID+": "+subdirectory,flush=True)
        
        
-       if not os.path.exists(os.path.join(outpath,patientID,subdirectory)):
-           os.makedirs(os.path.join(outpath,patientID,subdirectory))
+       out_subdirectory=os.path.join(outpath,patientID,subdirectory)
+       os.makedirs(out_subdirectory, exist_ok=True)
 
        #Copy image from the input folder
        if dif_path:
           try:
-              shutil.copy(os.path.join(patient_subdirectory,img_name),os.path.join(outpath,patientID,subdirectory,img_name))
+              copy_file(os.path.join(patient_subdirectory,img_name),os.path.join(out_subdirectory,img_name))
           except:
               print("\033[33mWARNING: the file "+img_name+" was not copied\033[0m",flush=True)
        
        try:
-           img = nib.load(os.path.join(patient_subdirectory,img_name))
+           #the image is only read: an uncompressed image is mapped read-only, without copy-on-write pages
+           img = nib.load(os.path.join(patient_subdirectory,img_name), mmap='r')
            msk = nib.load(os.path.join(patient_subdirectory,mask_name))
        except Exception as e:
            print("\033[31mERROR!\033[0m",e,flush=True)
@@ -288,15 +325,24 @@ def crop_volume(patient,inpath,outpath,min_thr,max_thr,img_name,mask_name,suffix
            continue 
  
        try:
-           img_data=img.get_fdata().astype(float)
+           #voxels are read in their on-disk dtype, integer images are thresholded as they are and
+           #float images are converted to float32 one slab at a time
+           img_data=np.asanyarray(img.dataobj)
        except Exception as e:
             print("\033[31mERROR!\033[0m",e,flush=True)
             print("\033[31mSkipping "+patientID+" "+subdirectory+"\033[0m",flush=True)
             eprint("Skipping "+patientID+" "+subdirectory)
             continue 
        try:    
-           msk_data = msk.get_fdata().astype(float)
-           msk_data = np.where((img_data >= float(min_thr)) & (img_data <= float(max_thr)), msk_data, 0)  
+           msk_data = np.asfortranarray(np.asanyarray(msk.dataobj))
+           if img_data.shape != msk_data.shape:
+               raise ValueError(f"mask shape {msk_data.shape} does not match image shape {img_data.shape}")
+           #remove voxels outside [min_thr, max_thr] from the mask in place, slab by slab,
+           #comparing only against the thresholds that some voxel of this dtype can fail
+           kernel, bounds, dtype = _threshold_kernel(img_data.dtype, lo, hi)
+           for slab in _slabs(img_data.shape) if kernel is not None else ():
+               # slabs along the last axis of a Fortran-ordered array are contiguous: the mask slab is a view
+               kernel(_flat(img_data[slab], dtype), np.ravel(msk_data[slab], order='F'), *bounds)
        except Exception as e:
             print("\033[31mERROR!\033[0m",e,flush=True)
             print("\033[31mSkipping "+patientID+" "+subdirectory+"\033[0m",flush=True)
@@ -304,12 +350,130 @@ def crop_volume(patient,inpath,outpath,min_thr,max_thr,img_name,mask_name,suffix
             continue 
                    
        try:
-           new_mask=nib.Nifti1Image(msk_data,affine=img.affine,header=img.header)
-           nib.save(new_mask,os.path.join(outpath,patientID,subdirectory,output_mask_name)) 
+           #save the mask in its own on-disk dtype, without scaling
+           msk_hdr=img.header.copy()
+           msk_hdr.set_data_dtype(msk.get_data_dtype())
+           msk_hdr.set_slope_inter(1.0, 0.0)
+           new_mask=nib.Nifti1Image(msk_data.astype(msk.get_data_dtype(), copy=False),affine=img.affine,header=msk_hdr)
+           save_nifti(new_mask,os.path.join(out_subdirectory,output_mask_name))
        except:
            print("\033[31mERROR! Saving final mask\033[0m",flush=True)
-           
-           
-           
+
+
+SLAB_VOXELS = 4 * 1024 * 1024
+
+def _slabs(shape):
+    """Yield the index of consecutive slabs of about SLAB_VOXELS voxels along the last axis."""
+    thickness = max(1, SLAB_VOXELS // max(1, int(np.prod(shape[:-1]))))
+    for z in range(0, shape[-1], thickness):
+        yield (Ellipsis, slice(z, min(z + thickness, shape[-1])))
+
+# conversion buffers of the process, by dtype, grown to the largest slab seen and reused for every slab and patient
+_scratch = {}
+
+def _flat(a, dtype):
+    """Return the voxels of `a` in Fortran order, as a 1-D array of `dtype`. A view when `a` already has
+    this dtype, else a conversion written into the reusable buffer of the dtype (valid until the next call)."""
+    dtype = np.dtype(dtype)
+    if a.dtype == dtype:
+        return np.ravel(a, order='F')
+    buf = _scratch.get(dtype)
+    if buf is None or buf.size < a.size:
+        buf = _scratch[dtype] = np.empty(a.size, dtype=dtype)
+    out = buf[:a.size]
+    out.reshape(a.shape, order='F')[...] = a
+    return out
+
+@numba.njit(parallel=True, cache=True)
+def _threshold(img, msk, lo, hi):
+    """Set `msk` to 0 where `img` is outside [lo, hi] (or NaN), in place and in a single pass."""
+    for i in numba.prange(img.size):
+        if not (img[i] >= lo and img[i] <= hi):
+            msk[i] = 0
+
+@numba.njit(parallel=True, cache=True)
+def _threshold_lo(img, msk, lo):
+    """Set `msk` to 0 where `img` is under lo (or NaN), in place."""
+    for i in numba.prange(img.size):
+        if not img[i] >= lo:
+            msk[i] = 0
+
+@numba.njit(parallel=True, cache=True)
+def _threshold_hi(img, msk, hi):
+    """Set `msk` to 0 where `img` is above hi (or NaN), in place."""
+    for i in numba.prange(img.size):
+        if not img[i] <= hi:
+            msk[i] = 0
+
+# The kernels are compiled on first use, never at import, so that the main process does not start
+# Numba's threads before the Pool forks (see NiftiIntensityResampling).
+
+def _threshold_kernel(dtype, lo, hi):
+    """Return the kernel, its bounds and the dtype to compare in, applying the float32 thresholds [lo, hi]
+    to an image of the given dtype. Integer images are compared in their own dtype, against lo rounded up
+    and hi rounded down to integers, other images in float32. A comparison that no value of the dtype
+    can fail (e.g. hi above the int16 range, or lo=-inf) is left out. Returns (None, (), None) when no
+    voxel can be removed."""
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        if lo > info.max or hi < info.min or np.ceil(lo) > np.floor(hi):
+            # every voxel is removed
+            return _threshold, (dtype.type(1), dtype.type(0)), dtype
+        need_lo = lo > info.min
+        need_hi = hi < info.max
+        if need_lo and need_hi:
+            return _threshold, (dtype.type(math.ceil(lo)), dtype.type(math.floor(hi))), dtype
+        if need_lo:
+            return _threshold_lo, (dtype.type(math.ceil(lo)),), dtype
+        if need_hi:
+            return _threshold_hi, (dtype.type(math.floor(hi)),), dtype
+        return None, (), None
+    need_lo = lo > -np.inf
+    need_hi = hi < np.inf
+    if need_lo and need_hi:
+        return _threshold, (lo, hi), np.float32
+    if need_hi:
+        return _threshold_hi, (hi,), np.float32
+    # lo alone, or no threshold at all: NaN voxels are still removed
+    return _threshold_lo, (lo,), np.float32
+
+_task = None
+
+def _init_worker(n_threads, log, task):
+    """Pool initializer: keep the task of the worker, redirect stdout to the log file, limit the Numba
+    threads of the worker and compile the kernels before the first task."""
+    global _task
+    _task = task
+    if log != '':
+        # opened once per worker, line buffered so that messages of the workers are not interleaved mid-line
+        sys.stdout = open(log,'a+',buffering=1)
+    numba.set_num_threads(n_threads)
+    msk = np.zeros(1, dtype=np.uint8)
+    # float32 images are passed as they are read: writable, or read-only when memory-mapped
+    for writeable in (True, False):
+        img = np.zeros(1, dtype=np.float32)
+        img.flags.writeable = writeable
+        _threshold(img, msk, np.float32(0), np.float32(0))
+        _threshold_lo(img, msk, np.float32(0))
+        _threshold_hi(img, msk, np.float32(0))
+
+def _run_task(patient):
+    """Run the task of the worker, set by _init_worker, on a patient."""
+    return _task(patient)
+
+def _float32_bounds(lo, hi):
+    """Return the float32 thresholds selecting exactly the same float32 voxels as [lo, hi]: lo rounded
+    up and hi rounded down to the nearest float32 (a plain cast would, e.g., round sys.float_info.min
+    to 0 and sys.float_info.max to inf)."""
+    with np.errstate(over='ignore'):
+        lo32 = np.float32(lo)
+        if float(lo32) < lo:
+            lo32 = np.nextafter(lo32, np.float32(np.inf))
+        hi32 = np.float32(hi)
+        if float(hi32) > hi:
+            hi32 = np.nextafter(hi32, np.float32(-np.inf))
+    return lo32, hi32
+
+
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -89,18 +89,27 @@ In these examples:
 #     NiftiMergeVolume_multiprocessing.py -h
 
 import sys, getopt, os
+# merging makes no BLAS or OpenMP calls: do not let numpy's libraries start a thread per core
+# in the main process and in each worker
+for _var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+    os.environ.setdefault(_var, "1")
 from tqdm import tqdm
-import glob
 import multiprocessing
-import shutil
+from functools import partial
 import re
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import nibabel as nib
 import numpy as np
+import numba
 from datetime import datetime
 from utils import eprint
 from utils import hprint
 from utils import hprint_msg_box
 from utils import format_list_multiline
+from utils import list_subfolders
+from utils import copy_file
 
 def main(argv):
     inpath = ''
@@ -207,6 +216,10 @@ def main(argv):
     if inpath == '':
         print("\033[31mERROR! No input folder specify\033[0m",flush=True)
         sys.exit()
+
+    if not os.path.isdir(inpath):
+        print(f"\033[31mERROR! Input folder {inpath} not found\033[0m",flush=True)
+        sys.exit()
         
     if reg=='' and len(add_list)==0:
         print("\033[31mERROR! the option --reg or --add need to used to select masks to add\033[0m",flush=True)
@@ -240,26 +253,31 @@ def main(argv):
 
         hprint_msg_box(msg=msg, indent=2, title=f"MERGE_MASKS {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
+    # kept as a list: the progress bar needs the number of patients
+    patients = list_subfolders(inpath)
+
+    # same arguments for every patient, bound once
+    task = partial(merge_volume,inpath=inpath,outpath=outpath,reg=reg,add_list=add_list,sub_list=sub_list,mask_name=mask_name,dif_path=dif_path,skip_files=skip_files,include_files=include_files,verbose=verbose)
+
     if n_jobs == 1:
-        for patient in tqdm(glob.glob(inpath+"/*"),
+        for patient in tqdm(patients,
                         ncols=100,
                         desc="Merge masks",
                         bar_format="{l_bar}{bar} [time left: {remaining}, time spent: {elapsed}]",
                         colour="yellow"):
-            merge_volume(patient,inpath,outpath,reg,add_list,sub_list,mask_name,dif_path,skip_files,include_files,verbose,log)
+            task(patient)
     else:    
-        with multiprocessing.Pool(n_jobs) as pool:
-            tqdm(pool.starmap(merge_volume,
-                              [(patient,inpath,outpath,reg,add_list,sub_list,mask_name,dif_path,skip_files,include_files,verbose,log) for patient in glob.glob(inpath+"/*")]),
+        # share the Numba threads between the workers instead of starting all of them in each worker
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(max(1, numba.config.NUMBA_NUM_THREADS // n_jobs), log)) as pool:
+            for _ in tqdm(pool.imap_unordered(task, patients, chunksize=max(1, len(patients)//(4*n_jobs))),
+                          total=len(patients),
                           ncols=100,
                           desc="Merge masks",
                           bar_format="{l_bar}{bar} [time left: {remaining}, time spent: {elapsed}]",
-                          colour="yellow")
+                          colour="yellow"):
+                pass
         
-def merge_volume(patient,inpath,outpath,reg,add_list,sub_list,mask_name,dif_path,skip_files,include_files,verbose,log):
-    if log != '':
-        f = open(log,'a+')
-        sys.stdout = f
+def merge_volume(patient,inpath,outpath,reg,add_list,sub_list,mask_name,dif_path,skip_files,include_files,verbose):
     patientID=os.path.basename(patient)
     
     if len(include_files) > 0: #if file to include are specify
@@ -280,7 +298,9 @@ def merge_volume(patient,inpath,outpath,reg,add_list,sub_list,mask_name,dif_path
     if not os.path.exists(os.path.join(outpath,patientID)):
        os.makedirs(os.path.join(outpath,patientID))
    
-    for patient_subdirectory in glob.glob(patient+"/*"):
+    reg_re = re.compile(reg, re.IGNORECASE) if reg != '' else None
+
+    for patient_subdirectory in list_subfolders(patient):
        subdirectory=os.path.basename(patient_subdirectory)
        if verbose:
            print(patientID+": "+subdirectory,flush=True)
@@ -288,9 +308,13 @@ def merge_volume(patient,inpath,outpath,reg,add_list,sub_list,mask_name,dif_path
        if not os.path.exists(os.path.join(outpath,patientID,subdirectory)):
            os.makedirs(os.path.join(outpath,patientID,subdirectory))
        
-       files_list=[f for f in os.listdir(patient_subdirectory) if os.path.isfile(os.path.join(patient_subdirectory,f))]
+       #the directory entries already tell which ones are files
+       with os.scandir(patient_subdirectory) as entries:
+           files_list=[entry.name for entry in entries if entry.is_file()]
 
-       img_idx=[i for i, item in enumerate (files_list) if re.search('.*img.*',item, re.IGNORECASE)]
+       #image and mask files are recognized by fixed, case-insensitive substrings
+       lower_names=[item.lower() for item in files_list]
+       img_idx=[i for i, item in enumerate (lower_names) if 'img' in item]
               
        if len(img_idx) == 0:
            print("\033[31mERROR! : image not found for the current subdirectory\033[0m",flush=True)
@@ -308,97 +332,63 @@ def merge_volume(patient,inpath,outpath,reg,add_list,sub_list,mask_name,dif_path
        #Copy image from the input folder
        if dif_path:
            try:
-               shutil.copy(os.path.join(patient_subdirectory,image_name),os.path.join(outpath,patientID,subdirectory,image_name))
+               copy_file(os.path.join(patient_subdirectory,image_name),os.path.join(outpath,patientID,subdirectory,image_name))
            except:
                print("\033[33mWARNING! The file "+image_name+" was not copied\033[0m",flush=True)
   
                
-       img = nib.load(os.path.join(patient_subdirectory,image_name))
-       mask_idx=[i for i, item in enumerate (files_list) if re.search('.*mask.*.nii.gz',item, re.IGNORECASE)]
-
        if reg != '':
-           PositiveMasks= [i for i, item in enumerate([files_list[j] for j in mask_idx]) if re.search(reg, item, re.IGNORECASE)]
-           NegativeMasks= [i for i, item in enumerate([files_list[j] for j in mask_idx]) if not re.search(reg, item, re.IGNORECASE)]
-           
+           #masks matching the regular expression are added, the others subtracted
+           PositiveMasks=[]
+           NegativeMasks=[]
+           for item, lower_name in zip(files_list, lower_names):
+               if 'mask' in lower_name and lower_name.endswith('.nii.gz'):
+                   (PositiveMasks if reg_re.search(item) else NegativeMasks).append(item)
 
            if verbose:
-               print("Masks to add: ", [files_list[int(mask_idx[int(i)])] for i in PositiveMasks])
-               print("Masks to substract: ", [files_list[int(mask_idx[int(i)])] for i in NegativeMasks])
-           
-           PositiveMask_Added = np.zeros((img.header['dim'][1], img.header['dim'][2], img.header['dim'][3]))
-           NegativeMask_Added = np.zeros_like(PositiveMask_Added)
-   
-           for i in PositiveMasks: 
-               try:   
-                   niftiAdd = nib.load(os.path.join(patient_subdirectory,files_list[int(mask_idx[int(i)])]))                    
-                   dataAdd = niftiAdd.get_fdata()
-                   PositiveMask_Added=PositiveMask_Added+dataAdd
-                   PositiveMask_Added[PositiveMask_Added != 0] = 1
-               except:
-                   print("\033[31mERROR! Computing positive mask\033[0m",flush=True)
-                   print(f"\033[31mSkipping image {patientID} {subdirectory}\033[0m",flush=True)
-                   eprint("Skipping "+patientID+" "+subdirectory+" (ERROR computing positive mask)")
-                   continue
-       
-           for i in NegativeMasks:
-               try:
-                    niftiAdd = nib.load(os.path.join(patient_subdirectory,files_list[int(mask_idx[int(i)])]))
-                    dataAdd = niftiAdd.get_fdata()
-                    NegativeMask_Added=NegativeMask_Added+dataAdd
-                    NegativeMask_Added[NegativeMask_Added != 0] = 1
-               except:
-                   print("\033[31mERROR! Computing negative mask\033[0m",flush=True)
-                   print(f"\033[31mSkipping image {patientID} {subdirectory}\033[0m",flush=True)
-                   eprint("Skipping "+patientID+" "+subdirectory+" (ERROR computing negative mask)")
-                   continue
+               print("Masks to add: ", PositiveMasks)
+               print("Masks to substract: ", NegativeMasks)
        else:     #use --add and --sub arguments to compute the mask
-           try:        
-               PositiveMasks=[files_list.index(item) for item in add_list]
-               NegativeMasks=[files_list.index(item) for item in sub_list]
-               
-               PositiveMask_Added = np.zeros((img.header['dim'][1], img.header['dim'][2], img.header['dim'][3]))
-               NegativeMask_Added = np.zeros_like(PositiveMask_Added)
-           except:
-               print("\033[31mERROR! Mask not found\033[0m",flush=True)
+           files_set=set(files_list)
+           missing=[item for item in add_list+sub_list if item not in files_set]
+           if len(missing) > 0:
+               print(f"\033[31mERROR! Mask not found: {', '.join(missing)}\033[0m",flush=True)
                print(f"\033[31mSkipping image {patientID} {subdirectory}\033[0m",flush=True)
                eprint("Skipping "+patientID+" "+subdirectory+" (ERROR mask not found)")
                continue
+           PositiveMasks=add_list
+           NegativeMasks=sub_list
 
-               
-           for i in PositiveMasks: 
-             try:    
-                 niftiAdd = nib.load(os.path.join(patient_subdirectory,files_list[int(i)]))
-                 dataAdd = niftiAdd.get_fdata()
-                 PositiveMask_Added=PositiveMask_Added+dataAdd
-                 PositiveMask_Added[PositiveMask_Added != 0] = 1
-             except:
-                 print("\033[31mERROR! Computing positive mask\033[0m",flush=True)
-                 print(f"\033[31mSkipping image {patientID} {subdirectory}\033[0m",flush=True)
-                 eprint("Skipping "+patientID+" "+subdirectory+" (ERROR computing positive mask)")
-                 continue
-               
-           for i in NegativeMasks:
-             try:
-                  niftiAdd = nib.load(os.path.join(patient_subdirectory,files_list[int(i)]))
-                  dataAdd = niftiAdd.get_fdata()
-                  NegativeMask_Added=NegativeMask_Added+dataAdd
-                  NegativeMask_Added[NegativeMask_Added != 0] = 1
-             except:
-                 print("\033[31mERROR! Computing negative mask\033[0m",flush=True)
-                 print(f"\033[31mSkipping image {patientID} {subdirectory}\033[0m",flush=True)
-                 eprint("Skipping "+patientID+" "+subdirectory+" (ERROR computing negative mask)")
-                 continue
-         
+       #a mask that cannot be read makes the merged mask wrong: the whole subdirectory is skipped
        try:
-           FinalMask=PositiveMask_Added-NegativeMask_Added
-           FinalMask[FinalMask != 1] = 0
-       except:
-           print("\033[31mERROR! Combining positive and negative masks\033[0m",flush=True)
+           #only the header of the image is used (affine, shape), its voxels are never read
+           img = nib.load(os.path.join(patient_subdirectory,image_name))
+           PositiveMask_Added, NegativeMask_Added = _accumulators(img.shape[:3])
+           _add_masks(PositiveMask_Added, [os.path.join(patient_subdirectory,item) for item in PositiveMasks])
+           #nothing to subtract from an empty positive mask: the negative masks are not read
+           if not PositiveMask_Added.any():
+               if verbose:
+                   print(f"\033[33mWARNING! The merged mask of {patientID} {subdirectory} is empty\033[0m",flush=True)
+               NegativeMasks=[]
+           _add_masks(NegativeMask_Added, [os.path.join(patient_subdirectory,item) for item in NegativeMasks])
+
+           if len(NegativeMasks) == 0:
+               #the positive mask is the final mask, viewed as uint8 without a copy
+               FinalMask=PositiveMask_Added.view(np.uint8)
+           else:
+               FinalMask=np.empty_like(PositiveMask_Added, dtype=np.uint8)
+               _and_not(np.ravel(PositiveMask_Added, order='F'), np.ravel(NegativeMask_Added, order='F'), np.ravel(FinalMask, order='F'))
+       except MASK_ERRORS as e:
+           print("\033[31mERROR! Computing the merged mask\033[0m",e,flush=True)
            print(f"\033[31mSkipping image {patientID} {subdirectory}\033[0m",flush=True)
-           eprint("Skipping "+patientID+" "+subdirectory+" (ERROR Combining positive and negative masks)")
+           eprint("Skipping "+patientID+" "+subdirectory+" (ERROR computing the merged mask)")
            continue
        try:
-           mask=nib.Nifti1Image(FinalMask,affine=img.affine,header=img.header)
+           #save the mask as uint8, without scaling, instead of in the dtype of the image
+           msk_hdr=img.header.copy()
+           msk_hdr.set_data_dtype(np.uint8)
+           msk_hdr.set_slope_inter(1.0, 0.0)
+           mask=nib.Nifti1Image(FinalMask,affine=img.affine,header=msk_hdr)
            nib.save(mask,os.path.join(outpath,patientID,subdirectory,mask_name)) 
        except:
            print("\033[31mERROR! Saving final mask\033[0m",flush=True)
@@ -406,5 +396,77 @@ def merge_volume(patient,inpath,outpath,reg,add_list,sub_list,mask_name,dif_path
            eprint("Skipping "+patientID+" "+subdirectory+" (ERROR Saving final mask)")
            continue
 
+
+# accumulators of the process, for the shape of the last volume, reused by the next subdirectories
+_scratch = {}
+
+def _accumulators(shape):
+    """Return cleared positive and negative accumulators for a volume of `shape`. They are reused while
+    the shape does not change (usually all the subdirectories of a patient), only the last shape is kept."""
+    acc = _scratch.get(shape)
+    if acc is None:
+        _scratch.clear()
+        acc = _scratch[shape] = (np.zeros(shape, dtype=bool, order='F'), np.zeros(shape, dtype=bool, order='F'))
+    else:
+        for a in acc:
+            a.fill(False)
+    return acc
+
+MASK_READERS = 4
+
+def _read_mask(path):
+    """Read a mask in its on-disk dtype. Uncompressed masks are read in full rather than memory-mapped,
+    so that the reading is done by the reader thread and not by page faults during the accumulation."""
+    return np.asanyarray(nib.load(path, mmap=False).dataobj)
+
+# errors of a missing, unreadable or corrupted mask (nibabel, gzip and zlib) or of a mask not matching the image
+MASK_ERRORS = (OSError, EOFError, ValueError, zlib.error, nib.filebasedimages.ImageFileError)
+
+def _add_masks(acc, paths):
+    """Set `acc` to True where one of the masks at `paths` is nonzero, in place. The masks are read by
+    MASK_READERS threads (file reads and gzip decompression release the GIL), at most MASK_READERS of
+    them ahead of the accumulation to bound memory."""
+    def add(path, future):
+        msk = future.result()
+        if msk.shape != acc.shape:
+            raise ValueError(f"{os.path.basename(path)}: mask shape {msk.shape} does not match image shape {acc.shape}")
+        # acc is Fortran-ordered (as nibabel arrays): its flat view is updated in place
+        _or_nonzero(np.ravel(acc, order='F'), np.ravel(msk, order='F'))
+    with ThreadPoolExecutor(max_workers=MASK_READERS) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append((path, executor.submit(_read_mask, path)))
+            if len(pending) > MASK_READERS:
+                add(*pending.popleft())
+        while pending:
+            add(*pending.popleft())
+
+@numba.njit(parallel=True, cache=True)
+def _or_nonzero(acc, msk):
+    """Set `acc` to True where `msk` is nonzero, in place and in a single pass."""
+    for i in numba.prange(acc.size):
+        if msk[i] != 0:
+            acc[i] = True
+
+@numba.njit(parallel=True, cache=True)
+def _and_not(pos, neg, out):
+    """Write 1 to `out` where `pos` is True and `neg` is False, 0 elsewhere."""
+    for i in numba.prange(out.size):
+        out[i] = pos[i] and not neg[i]
+
+# The kernels are compiled on first use, never at import, so that the main process does not start
+# Numba's threads before the Pool forks (see NiftiIntensityResampling).
+
+def _init_worker(n_threads, log):
+    """Pool initializer: redirect stdout to the log file, limit the Numba threads of the worker and
+    compile the kernels before the first task."""
+    if log != '':
+        # opened once per worker, line buffered so that messages of the workers are not interleaved mid-line
+        sys.stdout = open(log,'a+',buffering=1)
+    numba.set_num_threads(n_threads)
+    acc = np.zeros(1, dtype=np.bool_)
+    _or_nonzero(acc, np.zeros(1, dtype=np.uint8))
+    _and_not(acc, acc, np.zeros(1, dtype=np.uint8))
+
 if __name__ == "__main__":
     main(sys.argv[1:])                   
@@ -23,6 +23,12 @@ The `N4-BIAS-FIELD-CORRECTION` module supports the following options:
 - **corrected_image_filename**: Name for the corrected output image (default: img_n4biasCorr.nii.gz).
 - **bias_field_image_filename**: Specify an output name for saving the estimated bias field image (optional).
 - **suffix_name**: Suffix to add to the corrected image name, overriding `corrected_image_filename` if specified.
+- **shrink_factor**: Shrink factor of the image on which the bias field is estimated (default: 1, full resolution). Factors such as 4 make N4 much faster but change the corrected intensities (by up to about 20% on some voxels).
+- **max_iterations**: Comma-separated maximum number of iterations at each fitting level (default: 50,50,50,50).
+- **convergence_threshold**: Convergence threshold of the N4 iterations (default: 0.001).
+- **bias_field_fwhm**: Full width at half maximum of the Gaussian deconvolution of the bias field (default: 0.15).
+- **compression_level**: gzip compression level (1-9) of the .nii.gz outputs (default: 6).
+- **itk_threads**: Number of ITK threads used by each job for the correction (default: available cores divided by `multiprocessing`).
 
 Example Usage
 -------------
@@ -72,20 +78,37 @@ In this example:
 #       --log <log file path>        Redirect stdout to a log file
 #       --new_log                    Overwrite the previous log file if it exists
 #   -j, --n_jobs <number of jobs>    Number of simultaneous jobs (default: 1)
+#       --shrink_factor <factor>     Shrink factor of the image used to estimate the bias field (default: 1)
+#       --max_iterations <n1,n2,...> Maximum number of iterations at each fitting level (default: 50,50,50,50)
+#       --convergence_threshold <t>  Convergence threshold of the iterations (default: 0.001)
+#       --bias_field_fwhm <fwhm>     Full width at half maximum of the bias field deconvolution (default: 0.15)
+#       --compression_level <level>  gzip compression level (1-9) of the .nii.gz outputs (default: 6)
+#       --itk_threads <number>       Number of ITK threads per job (default: available cores / n_jobs)
 #
 # Help:
 #     NiftiN4BiasFieldCorrection_multiprocessing.py -h
 
 import sys, getopt, os
+import stat
 from tqdm import tqdm
-import SimpleITK as sitk
-import glob
+import nibabel as nib
+import numpy as np
+import subprocess
 import multiprocessing
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from utils import hprint
 from utils import eprint
 from utils import hprint_msg_box
 from utils import format_list_multiline
+from utils import list_subfolders
+from utils import available_cores
+from utils import PIGZ
+from utils import advise_sequential_read
+
+# SimpleITK is imported by the processes running N4 (see _import_sitk), not by the parent of the pool workers
+sitk = None
 
 def main(argv):
     inpath = ''
@@ -103,12 +126,18 @@ def main(argv):
     include_files = []
     log = ''
     new_log = False
+    itk_threads = 0
+    shrink_factor = 1
+    max_iterations = [50, 50, 50, 50]
+    convergence_threshold = 0.001
+    bias_field_fwhm = 0.15
+    compression_level = 6
 
     try:
-        opts, args = getopt.getopt(argv, "h:vi:o:j:S:e:", ["log=", "new_log", "n_jobs=", "verbose", "help", "inputFolder=", "outputFolder=", "img_name=", "msk_name=", "corrected_img_name=", "bias_field_name=", "skip=", "include="])
+        opts, args = getopt.getopt(argv, "h:vi:o:j:S:e:", ["log=", "new_log", "n_jobs=", "verbose", "help", "inputFolder=", "outputFolder=", "img_name=", "msk_name=", "corrected_img_name=", "bias_field_name=", "skip=", "include=", "itk_threads=", "shrink_factor=", "max_iterations=", "convergence_threshold=", "bias_field_fwhm=", "compression_level="])
     except getopt.GetoptError as err:
         print(f'Error: {err.msg}')
-        print('Usage: NiftiN4BiasFieldCorrection_multiprocessing.py [-h|--help] [-v|--verbose] [-i|--inputFolder <inputfolder>] [-o|--outputFolder <outfolder>] [--img_name <image name>] [--msk_name <mask name>] [--corrected_img_name <corrected image name>] [--bias_field_name <bias field image name>] [-e <suffix>] [--skip <skip file path>] [--include <include file path>] [--log <log file path>] [-j|--n_jobs <number of simultaneous jobs>]')
+        print('Usage: NiftiN4BiasFieldCorrection_multiprocessing.py [-h|--help] [-v|--verbose] [-i|--inputFolder <inputfolder>] [-o|--outputFolder <outfolder>] [--img_name <image name>] [--msk_name <mask name>] [--corrected_img_name <corrected image name>] [--bias_field_name <bias field image name>] [-e <suffix>] [--skip <skip file path>] [--include <include file path>] [--log <log file path>] [-j|--n_jobs <number of simultaneous jobs>] [--shrink_factor <shrink factor>] [--max_iterations <n1,n2,...>] [--convergence_threshold <threshold>] [--bias_field_fwhm <fwhm>] [--compression_level <level>] [--itk_threads <number of ITK threads per job>]')
         sys.exit(2)
 
     for opt, arg in opts:
@@ -119,7 +148,9 @@ def main(argv):
             print("\tNiftiN4BiasFieldCorrection_multiprocessing.py [-h|--help] [-v|--verbose] [-i|--inputFolder <inputfolder>] "
                   "[-o|--outputFolder <outfolder>] [--img_name <image name>] [--msk_name <mask name>] "
                   "[--corrected_img_name <corrected image name>] [-e <suffix>] [--skip <skip file path>] "
-                  "[--include <include file path>] [--log <log file path>] [-j|--n_jobs <number of simultaneous jobs>]\n")
+                  "[--include <include file path>] [--log <log file path>] [-j|--n_jobs <number of simultaneous jobs>] "
+                  "[--shrink_factor <shrink factor>] [--max_iterations <n1,n2,...>] [--convergence_threshold <threshold>] "
+                  "[--bias_field_fwhm <fwhm>] [--compression_level <level>] [--itk_threads <number of ITK threads per job>]\n")
             print("DESCRIPTION")
             print("\tPerform N4 bias field correction on NIfTI images.\n")
             print("OPTIONS")
@@ -137,6 +168,12 @@ def main(argv):
             print("\t --log: Redirect stdout to a log file")
             print("\t --new_log: Overwrite the previous log file")
             print("\t -j, --n_jobs: Number of simultaneous jobs (default: 1)")
+            print("\t --shrink_factor: Shrink factor of the image used to estimate the bias field (default: 1, full resolution; e.g. 4 is faster but changes the corrected intensities)")
+            print("\t --max_iterations: Comma-separated maximum number of iterations at each fitting level (default: 50,50,50,50)")
+            print("\t --convergence_threshold: Convergence threshold of the N4 iterations (default: 0.001)")
+            print("\t --bias_field_fwhm: Full width at half maximum of the bias field deconvolution (default: 0.15)")
+            print("\t --compression_level: gzip compression level (1-9) of the .nii.gz outputs (default: 6)")
+            print("\t --itk_threads: Number of ITK threads used by each job (default: available cores / n_jobs)")
             sys.exit(0)
         elif opt in ("-i", "--inputFolder"):
             inpath = arg
@@ -164,6 +201,18 @@ def main(argv):
             bias_field_name = arg
         elif opt in ("-e"):
             suffix = arg
+        elif opt in ("--itk_threads"):
+            itk_threads = int(arg)
+        elif opt in ("--shrink_factor"):
+            shrink_factor = max(1, int(arg))
+        elif opt in ("--max_iterations"):
+            max_iterations = [int(n) for n in arg.strip("[]").split(",")]
+        elif opt in ("--convergence_threshold"):
+            convergence_threshold = float(arg)
+        elif opt in ("--bias_field_fwhm"):
+            bias_field_fwhm = float(arg)
+        elif opt in ("--compression_level"):
+            compression_level = min(9, max(1, int(arg)))
 
     if log != '':
         if new_log:
@@ -198,6 +247,14 @@ def main(argv):
         print("\033[31mERROR! No input folder specified\033[0m", flush=True)
         sys.exit(1)
 
+    if not os.path.isdir(inpath):
+        print(f"\033[31mERROR! Input folder {inpath} not found\033[0m", flush=True)
+        sys.exit(1)
+
+    # N4 is multi-threaded by ITK: each job gets its share of the cores, otherwise every process would start one thread per core
+    if itk_threads <= 0:
+        itk_threads = max(1, available_cores() // n_jobs)
+
     if verbose:
         msg = (
             f"Input path: {inpath}\n"
@@ -207,7 +264,13 @@ def main(argv):
             f"Corrected image name: {corrected_img}\n"
             f"Bias field image name: {bias_field_name}\n"
             f"Output suffix name: {suffix}\n"
+            f"Shrink factor: {shrink_factor}\n"
+            f"Maximum number of iterations: {max_iterations}\n"
+            f"Convergence threshold: {convergence_threshold}\n"
+            f"Bias field FWHM: {bias_field_fwhm}\n"
+            f"Compression level: {compression_level}\n"
             f"n_jobs: {n_jobs}\n"
+            f"ITK threads per job: {itk_threads}\n"
             f"Skip file: {skip_file_name}\n"
             f"Files to skip: {format_list_multiline(skip_files, 5)}\n"
             f"Include file: {include_file_name}\n"
@@ -219,23 +282,38 @@ def main(argv):
 
         hprint_msg_box(msg=msg, indent=2, title=f"N4_BIAS_FIELD_CORRECTION {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
+    # constant-time membership tests in the workers (the lists are only kept for the verbose output)
+    skip_files = frozenset(skip_files)
+    include_files = frozenset(include_files)
+
+    # kept as a list: the progress bar needs the number of patients
+    patients = list_subfolders(inpath)
+    # same arguments for every patient, bound once
+    task = partial(correct_bias_field, inpath=inpath, outpath=outpath, img_name=img, msk_name=msk, corrected_img_name=corrected_img, bias_field_name=bias_field_name, suffix=suffix, shrink_factor=shrink_factor, compression_level=compression_level, skip_files=skip_files, include_files=include_files, verbose=verbose, log=log)
+
+    n4_options = (max_iterations, convergence_threshold, bias_field_fwhm)
     if n_jobs == 1:
-        for patient in tqdm(glob.glob(inpath + "/*"),
+        _import_sitk()
+        _set_itk_threads(itk_threads)
+        _init_corrector(*n4_options)
+        for patient in tqdm(patients,
                             ncols=100,
                             desc="N4 Bias Field Correction",
                             bar_format="{l_bar}{bar} [time left: {remaining}, time spent: {elapsed}]",
                             colour="yellow"):
-            correct_bias_field(patient, inpath, outpath, img, msk, corrected_img, bias_field_name, suffix, skip_files, include_files, verbose, log)
+            task(patient)
     else:
-        with multiprocessing.Pool(n_jobs) as pool:
-            tqdm(pool.starmap(correct_bias_field,
-                              [(patient, inpath, outpath, img, msk, corrected_img, bias_field_name, suffix, skip_files, include_files, verbose, log) for patient in glob.glob(inpath + "/*")]),
-                 ncols=100,
-                 desc="N4 Bias Field Correction",
-                 bar_format="{l_bar}{bar} [time left: {remaining}, time spent: {elapsed}]",
-                 colour="yellow")
-
-def correct_bias_field(patient, inpath, outpath, img_name, msk_name, corrected_img_name, bias_field_name, suffix, skip_files, include_files, verbose, log):
+        # the task and its arguments reach each worker once, through the initializer: only patient paths are sent per chunk
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(task, itk_threads, n4_options, log)) as pool:
+            for _ in tqdm(pool.imap_unordered(_run_task, patients, chunksize=max(1, len(patients) // (4 * n_jobs))),
+                          total=len(patients),
+                          ncols=100,
+                          desc="N4 Bias Field Correction",
+                          bar_format="{l_bar}{bar} [time left: {remaining}, time spent: {elapsed}]",
+                          colour="yellow"):
+                pass
+
+def correct_bias_field(patient, inpath, outpath, img_name, msk_name, corrected_img_name, bias_field_name, suffix, shrink_factor, compression_level, skip_files, include_files, verbose, log):
     patientID = os.path.basename(patient)
 
     if len(include_files) > 0 and patientID not in include_files:
@@ -251,74 +329,224 @@ def correct_bias_field(patient, inpath, outpath, img_name, msk_name, corrected_i
     if verbose:
         hprint(f"Processing {patientID}", patient)
 
-    if not os.path.exists(os.path.join(outpath, patientID)):
-        os.makedirs(os.path.join(outpath, patientID))
+    os.makedirs(os.path.join(outpath, patientID), exist_ok=True)
    
-    for patient_subdirectory in glob.glob(patient+"/*"):
-       subdirectory=os.path.basename(patient_subdirectory)
-       if verbose:
-           print(f"{patientID}: {subdirectory}", flush=True)
-       
-       if not os.path.exists(os.path.join(outpath,patientID,subdirectory)):
-           os.makedirs(os.path.join(outpath,patientID,subdirectory))
-       
-       try: 
-           img = sitk.ReadImage(os.path.join(patient_subdirectory, img_name))
-       except FileNotFoundError:
-            print(f"\033[31mERROR reading image {os.path.join(patient, img_name)}\033[0m", flush=True)
-            eprint(f"Skipping {patientID} (ERROR reading image)")
-            continue
-       except Exception as e:
-           print(f"\033[31mERROR:\033[0m {e}", flush=True)
-           print("\033[31mSkipping image"+patientID+" "+subdirectory+"\033[0m",flush=True)
-           eprint("Skipping "+patientID+" "+subdirectory+" (ERROR reading image)")
-           continue
-    
-       mask = None
-       if msk_name != '':
-           try:
-               mask = sitk.ReadImage(os.path.join(patient_subdirectory, msk_name))
-           except FileNotFoundError:
-               print(f"\033[31mERROR reading mask {os.path.join(patient, msk_name)}\033[0m", flush=True)
-               eprint(f"Skipping {patientID} (ERROR reading mask)")
-               continue
-           except Exception as e:
-               print(f"\033[31mERROR:\033[0m {e}", flush=True)
-               print("\033[31mSkipping image"+patientID+" "+subdirectory+"\033[0m",flush=True)
-               eprint("Skipping "+patientID+" "+subdirectory+" (ERROR reading mask)")
+    patient_subdirectories = list_subfolders(patient)
+    if suffix:
+        corrected_img_name = os.path.splitext(os.path.splitext(img_name)[0])[0] + "_" + suffix + ".nii.gz"
+    # the inputs of the next subdirectory are read and the outputs of the previous one are written
+    # by two threads while N4 runs on the current one (nibabel, zlib and SimpleITK release the GIL)
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+       def prefetch(patient_subdirectory):
+           img_path = os.path.join(patient_subdirectory, img_name)
+           msk_path = os.path.join(patient_subdirectory, msk_name) if msk_name != '' else None
+           # missing or empty files are not submitted (their future is None), the subdirectory is skipped without reading
+           img_future = mask_future = None
+           # the kernel starts reading both files while the reader thread decompresses the image
+           if _is_nonempty_file(img_path):
+               advise_sequential_read(img_path)
+               img_future = reader.submit(_read_image, img_path)
+           if msk_path is not None and _is_nonempty_file(msk_path):
+               advise_sequential_read(msk_path)
+               mask_future = reader.submit(_read_image, msk_path, True)
+           return img_path, img_future, msk_path, mask_future
+
+       writes = []
+       inputs = prefetch(patient_subdirectories[0]) if len(patient_subdirectories) > 0 else None
+       for n, patient_subdirectory in enumerate(patient_subdirectories):
+          img_path, img_future, msk_path, mask_future = inputs
+          inputs = prefetch(patient_subdirectories[n+1]) if n+1 < len(patient_subdirectories) else None
+          subdirectory=os.path.basename(patient_subdirectory)
+          if verbose:
+              print(f"{patientID}: {subdirectory}", flush=True)
+          
+          if img_future is None:
+              print(f"\033[31mERROR image {img_path} not found or empty\033[0m", flush=True)
+              eprint(f"Skipping {patientID} {subdirectory} (image not found)")
+              continue
+          if msk_path is not None and mask_future is None:
+              print(f"\033[31mERROR mask {msk_path} not found or empty\033[0m", flush=True)
+              eprint(f"Skipping {patientID} {subdirectory} (mask not found)")
+              continue
+
+          try: 
+              img = img_future.result()
+          except FileNotFoundError:
+               print(f"\033[31mERROR reading image {img_path}\033[0m", flush=True)
+               eprint(f"Skipping {patientID} (ERROR reading image)")
                continue
-       try:
-           # Perform check and cast the image if needed
-           pixel_type = img.GetPixelIDTypeAsString() 
-           if pixel_type != "32-bit float" and pixel_type != "64-bit float":
-               print(f"\033[33mWARNING! Casting image to 32-bit float. SimpleITK does not support {pixel_type} for 3D bias field correction\033[0m",flush=True)
-               img = sitk.Cast(img, sitk.sitkFloat32)
-           # Check and cast the mask to an appropriate type
-           mask_pixel_type = mask.GetPixelIDTypeAsString()
-           if mask_pixel_type not in ["8-bit unsigned integer", "16-bit unsigned integer"]:
-               print(f"\033[33mWARNING! Casting mask to 8-bit unsigned integer. SimpleITK does not support {mask_pixel_type} for masks in 3D bias field correction\033[0m", flush=True)
-               mask = sitk.Cast(mask, sitk.sitkUInt8)
-            
-           corrector = sitk.N4BiasFieldCorrectionImageFilter()
-           if mask:
-               corrected_img = corrector.Execute(img, mask)
-           else:
-               corrected_img = corrector.Execute(img)
-           if bias_field_name != '':
-               bias_field = corrector.GetLogBiasFieldAsImage(img)
-               sitk.WriteImage(bias_field, os.path.join(outpath, patientID,subdirectory, bias_field_name))
-               if verbose:
-                    print(f"Saved bias field image to {os.path.join(outpath, patientID, bias_field_name)}", flush=True)
-                
-           if suffix:
-               corrected_img_name = os.path.splitext(os.path.splitext(img_name)[0])[0] + "_" + suffix + ".nii.gz"
-    
-           sitk.WriteImage(corrected_img, os.path.join(outpath, patientID,subdirectory, corrected_img_name))
-           if verbose:
-               print(f"Saved corrected image to {os.path.join(outpath, patientID, corrected_img_name)}", flush=True)
-       except Exception as e:
-           print(f"\033[31mERROR during N4 bias field correction: {e}\033[0m", flush=True)
-           eprint(f"Skipping {patientID} (ERROR during correction)")
+          except Exception as e:
+              print(f"\033[31mERROR:\033[0m {e}", flush=True)
+              print("\033[31mSkipping image"+patientID+" "+subdirectory+"\033[0m",flush=True)
+              eprint("Skipping "+patientID+" "+subdirectory+" (ERROR reading image)")
+              continue
+       
+          mask = None
+          if mask_future is not None:
+              try:
+                  mask = mask_future.result()
+              except FileNotFoundError:
+                  print(f"\033[31mERROR reading mask {msk_path}\033[0m", flush=True)
+                  eprint(f"Skipping {patientID} (ERROR reading mask)")
+                  continue
+              except Exception as e:
+                  print(f"\033[31mERROR:\033[0m {e}", flush=True)
+                  print("\033[31mSkipping image"+patientID+" "+subdirectory+"\033[0m",flush=True)
+                  eprint("Skipping "+patientID+" "+subdirectory+" (ERROR reading mask)")
+                  continue
+          try:
+              # Perform check and cast the image if needed
+              if img.GetPixelID() not in (sitk.sitkFloat32, sitk.sitkFloat64):
+                  print(f"\033[33mWARNING! Casting image to 32-bit float. SimpleITK does not support {img.GetPixelIDTypeAsString()} for 3D bias field correction\033[0m",flush=True)
+                  img = sitk.Cast(img, sitk.sitkFloat32)
+              # Check and cast the mask to an appropriate type
+              if mask is not None and mask.GetPixelID() not in (sitk.sitkUInt8, sitk.sitkUInt16):
+                  print(f"\033[33mWARNING! Casting mask to 8-bit unsigned integer. SimpleITK does not support {mask.GetPixelIDTypeAsString()} for masks in 3D bias field correction\033[0m", flush=True)
+                  mask = sitk.Cast(mask, sitk.sitkUInt8)
+          except Exception as e:
+              print(f"\033[31mERROR casting image or mask: {e}\033[0m", flush=True)
+              eprint(f"Skipping {patientID} {subdirectory} (ERROR casting image or mask)")
+              continue
+
+          try:
+              corrected_img, bias_field = _correct(img, mask, shrink_factor, bias_field_name != '')
+          except Exception as e:
+              print(f"\033[31mERROR during N4 bias field correction: {e}\033[0m", flush=True)
+              eprint(f"Skipping {patientID} {subdirectory} (ERROR during correction)")
+              continue
+
+          # at most one subdirectory is waiting to be written
+          _wait_writes(writes, patientID, verbose)
+          writes = []
+          out_subdirectory = os.path.join(outpath,patientID,subdirectory)
+          os.makedirs(out_subdirectory, exist_ok=True)
+          if bias_field is not None:
+              writes.append((writer.submit(_write_image, bias_field, os.path.join(out_subdirectory, bias_field_name), compression_level),
+                             f"Saved bias field image to {os.path.join(out_subdirectory, bias_field_name)}"))
+          writes.append((writer.submit(_write_image, corrected_img, os.path.join(out_subdirectory, corrected_img_name), compression_level),
+                         f"Saved corrected image to {os.path.join(out_subdirectory, corrected_img_name)}"))
+       _wait_writes(writes, patientID, verbose)
+
+def _correct(img, mask, shrink_factor, keep_bias_field):
+    """Run the N4 filter of the process on img (within mask when it is not None).
+    Return the corrected image and, when keep_bias_field is True, the log bias field (None otherwise)."""
+    if shrink_factor > 1:
+        # the bias field is smooth: it is estimated on the shrunk image, then its B-spline is evaluated at full resolution
+        shrink = [shrink_factor] * img.GetDimension()
+        if mask is not None:
+            _corrector.Execute(sitk.Shrink(img, shrink), sitk.Shrink(mask, shrink))
+        else:
+            _corrector.Execute(sitk.Shrink(img, shrink))
+        # evaluated once at full resolution, for the correction and the saved bias field
+        log_bias_field = _corrector.GetLogBiasFieldAsImage(img)
+        if log_bias_field.GetPixelID() != img.GetPixelID():
+            log_bias_field = sitk.Cast(log_bias_field, img.GetPixelID())
+        # sitk.Divide keeps the pixel type of its inputs (the / operator is DivideReal, which outputs 64-bit floats)
+        return sitk.Divide(img, sitk.Exp(log_bias_field)), (log_bias_field if keep_bias_field else None)
+    if mask is not None:
+        corrected_img = _corrector.Execute(img, mask)
+    else:
+        corrected_img = _corrector.Execute(img)
+    return corrected_img, (_corrector.GetLogBiasFieldAsImage(img) if keep_bias_field else None)
+
+def _wait_writes(writes, patientID, verbose):
+    """Wait for the (future, message) writes of a subdirectory, printing the message or the error of each one."""
+    for future, msg in writes:
+        try:
+            future.result()
+            if verbose:
+                print(msg, flush=True)
+        except Exception as e:
+            print(f"\033[31mERROR writing image: {e}\033[0m", flush=True)
+            eprint(f"Skipping {patientID} (ERROR writing image)")
+
+_task = None
+
+def _import_sitk():
+    """Import SimpleITK in the process, as the module global sitk."""
+    global sitk
+    import SimpleITK as sitk
+
+def _set_itk_threads(n_threads):
+    """Set the number of threads of the ITK filters of the process. The platform threader starts its threads per
+    filter execution, unlike the ITK thread pool which does not survive a fork."""
+    sitk.ProcessObject_SetGlobalDefaultThreader("Platform")
+    sitk.ProcessObject_SetGlobalDefaultNumberOfThreads(n_threads)
+
+_corrector = None
+
+def _init_corrector(max_iterations, convergence_threshold, bias_field_fwhm):
+    """Create the N4 filter of the process, configured once and executed on every image."""
+    global _corrector
+    _corrector = sitk.N4BiasFieldCorrectionImageFilter()
+    _corrector.SetMaximumNumberOfIterations(max_iterations)
+    _corrector.SetConvergenceThreshold(convergence_threshold)
+    _corrector.SetBiasFieldFullWidthAtHalfMaximum(bias_field_fwhm)
+
+def _init_worker(task, n_threads, n4_options, log):
+    """Pool initializer: keep the task of the worker, redirect stdout to the log file, set its number of
+    ITK threads and create its N4 filter."""
+    global _task
+    _task = task
+    if log != '':
+        # opened once per worker, line buffered so that messages of the workers are not interleaved mid-line
+        sys.stdout = open(log, 'a+', buffering=1)
+    _import_sitk()
+    _set_itk_threads(n_threads)
+    _init_corrector(*n4_options)
+
+def _run_task(patient):
+    """Run the task of the worker, set by _init_worker, on a patient."""
+    return _task(patient)
+
+def _is_nonempty_file(path):
+    """Return True if path is a regular file that is not empty, with a single stat."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return stat.S_ISREG(st.st_mode) and st.st_size > 0
+
+def _read_image(path, is_mask=False):
+    """Read a NIfTI file with nibabel, much faster than sitk.ReadImage on .nii.gz files, into a SimpleITK image.
+    Images are read as float32 (float64 images stay float64), the pixel types of N4. Masks are read in their
+    dtype when it is uint8 or uint16 and converted to uint8 otherwise, as sitk.Cast did."""
+    nii = nib.load(path)
+    if is_mask:
+        data = np.asanyarray(nii.dataobj)
+        if data.dtype not in (np.uint8, np.uint16):
+            data = data.astype(np.uint8)
+    else:
+        data = nii.get_fdata(dtype=np.float64 if nii.get_data_dtype() == np.float64 else np.float32)
+    if data.ndim == 4 and data.shape[3] == 1:
+        data = data[..., 0]
+    # nibabel arrays are indexed (x, y, z), SimpleITK expects numpy arrays indexed (z, y, x)
+    sitk_img = sitk.GetImageFromArray(data.T)
+    # nibabel affines map to RAS+ coordinates, ITK images are in LPS+ coordinates
+    affine = np.diag([-1.0, -1.0, 1.0, 1.0]) @ nii.affine
+    spacing = np.linalg.norm(affine[:3, :3], axis=0)
+    sitk_img.SetSpacing(spacing.tolist())
+    sitk_img.SetDirection((affine[:3, :3] / spacing).ravel().tolist())
+    sitk_img.SetOrigin(affine[:3, 3].tolist())
+    return sitk_img
+
+def _write_image(img, path, compression_level, threads=2):
+    """Write a SimpleITK image at the given gzip compression level. When pigz is installed, .nii.gz files are
+    written uncompressed then compressed by pigz on `threads` threads, instead of by zlib in the writing thread."""
+    if PIGZ is not None and path.endswith(".nii.gz"):
+        tmp_path = path[:-len(".nii.gz")] + ".tmp.nii"
+        sitk.WriteImage(img, tmp_path, useCompression=False)
+        try:
+            with open(path, 'wb') as f:
+                subprocess.run([PIGZ, f"-{compression_level}", "-c", "-p", str(threads), tmp_path], stdout=f, check=True)
+        finally:
+            os.remove(tmp_path)
+        return
+    writer = sitk.ImageFileWriter()
+    writer.SetFileName(path)
+    writer.SetUseCompression(True)
+    writer.SetCompressionLevel(compression_level)
+    writer.Execute(img)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
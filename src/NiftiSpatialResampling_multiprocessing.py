@@ -25,6 +25,7 @@ The `SPATIAL_RESAMPLING` module accepts the following options:
 - **use_c3d**: Use the c3d program for resampling instead of SimpleITK.
 - **voxel_size**: Specify the x, y, and z dimensions of the voxels in mm³. Only isotropic resampling is supported (default: 1).
 - **suffix_name**: Add a suffix to resampled image and segmentation files (default: "111").
+- **skip_up_to_date**: Do not resample files whose output already exists and is newer than the input, e.g. when re-running an interrupted pipeline with the same options (default: False).
 
 Example Usage
 -------------
@@ -74,22 +75,28 @@ In this example:
 #       --log                    Path to a log file for saving output details
 #       --new_log                Overwrite an existing log file if it exists
 #       --use_c3d                Use c3d program for resampling instead of SimpleITK (default: False)
+#       --skip_up_to_date        Do not resample files whose output exists and is newer than the input (default: False)
 #
 # Help: NiftiResampling_multiprocessing.py -h
 
 import sys, getopt, os
 import glob
+import re
 import subprocess
-import shlex
 import multiprocessing
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import nibabel as nib
 import numpy as np
 import SimpleITK as sitk
+import numba
 from tqdm import tqdm
 from datetime import datetime
 from utils import hprint_msg_box
 from utils import hprint
 from utils import format_list_multiline
+from utils import available_cores
+from utils import list_subfolders
 
 def main(argv):
     inpath = ''
@@ -110,12 +117,13 @@ def main(argv):
     NoSegmentation = False
     AllSegmentation = False
     use_c3d = False
+    skip_up_to_date = False
 
     
     try:
-        opts, args = getopt.getopt(argv, "hvi:o:j:s:I:M:e:S:",["log=","new_log","inputFolder=","outputFolder=","verbose","help","n_jobs=","size=","interpolation=","mask_interpolation=","skip=","include=","no-segmentation","all-segmentation","use_c3d"])
+        opts, args = getopt.getopt(argv, "hvi:o:j:s:I:M:e:S:",["log=","new_log","inputFolder=","outputFolder=","verbose","help","n_jobs=","size=","interpolation=","mask_interpolation=","skip=","include=","no-segmentation","all-segmentation","use_c3d","skip_up_to_date"])
     except getopt.GetoptError:
-        print('Usage: NiftiResampling_multiprocessing.py -i <inputFolder> -o <outputFolder> [-v] [-e <suffix>] [-s <size>] [-I <interpolation>] [-M <mask_interpolation>] [-j <numJobs>] [--skip <skipFile>] [--include <includeFile>] [--no-segmentation] [--all-segmentation] [--log <logFile>]')
+        print('Usage: NiftiResampling_multiprocessing.py -i <inputFolder> -o <outputFolder> [-v] [-e <suffix>] [-s <size>] [-I <interpolation>] [-M <mask_interpolation>] [-j <numJobs>] [--skip <skipFile>] [--include <includeFile>] [--no-segmentation] [--all-segmentation] [--log <logFile>] [--use_c3d] [--skip_up_to_date]')
         sys.exit(2)
     for opt,arg in opts:
         if opt in ("-h", "--help"):
@@ -141,6 +149,8 @@ def main(argv):
             print("\t --log: redirect stdout to a log file")
             print("\t --new_log: overwrite previous log file")
             print("\t -j, --n_jobs: number of simultaneous jobs (default:1)")
+            print("\t --use_c3d: use c3d program for resampling instead of SimpleITK (default False)")
+            print("\t --skip_up_to_date: do not resample files whose output exists and is newer than the input (default False)")
             sys.exit()
         elif opt in ("-i", "--inputFolder"):
             inpath = arg
@@ -172,6 +182,8 @@ def main(argv):
               AllSegmentation = True        
         elif opt in ("--use_c3d"):
             use_c3d = True
+        elif opt in ("--skip_up_to_date"):
+            skip_up_to_date = True
     
     if log != '':
         if new_log:
@@ -208,6 +220,7 @@ def main(argv):
             f"Interpolation method for the mask: {mask_interpolation}\n"
             f"No segmentation: {NoSegmentation}\n"
             f"All data segmented: {AllSegmentation}\n"
+            f"Skip up-to-date outputs: {skip_up_to_date}\n"
             )
         
         if use_c3d:
@@ -230,39 +243,95 @@ def main(argv):
         print("\033[31mERROR! Input and output paths must be different\033[0m", flush=True)
         sys.exit()
     else:
+        # constant-time membership tests in the workers (the lists are only kept for the verbose output)
+        skip_files = frozenset(skip_files)
+        include_files = frozenset(include_files)
+
+        # kept as a list: the progress bar needs the number of patients
+        patients = list_subfolders(inpath)
+        # same arguments for every patient and every file, bound once
+        plan = partial(process_patient,outpath=outpath,suffix=suffix,skip_files=skip_files,include_files=include_files,verbose=verbose,NoSegmentation=NoSegmentation,AllSegmentation=AllSegmentation,skip_up_to_date=skip_up_to_date)
+        resample = partial(resample_files,size=size,interpolation=interpolation,mask_interpolation=mask_interpolation,path_to_c3d=path_to_c3d,verbose=verbose,use_c3d=use_c3d)
         if n_jobs == 1:
-           for patient in tqdm(glob.glob(inpath+"/*"),
+           for patient in tqdm(patients,
                               ncols=100,
                               desc="NIFTI Spatial resampling",
                               bar_format="{l_bar}{bar} [time left: {remaining}, time spent: {elapsed}]",
                               colour="yellow"):
-               process_patient(patient,outpath,size, interpolation, mask_interpolation, suffix, path_to_c3d, skip_files,include_files, verbose,log,NoSegmentation,AllSegmentation,use_c3d)
+               resample(plan(patient))
         else:
-            with multiprocessing.Pool(n_jobs) as pool:
-                tqdm(pool.starmap(process_patient,
-                                  [(patient,outpath,size, interpolation, mask_interpolation, suffix, path_to_c3d, skip_files,include_files,verbose,log,NoSegmentation,AllSegmentation,use_c3d) for patient in glob.glob(inpath+"/*")]),
-                            ncols=100,
-                            desc="NIFTI Spatial resampling",
-                            bar_format="{l_bar}{bar} [time left: {remaining}, time spent: {elapsed}]",
-                            colour="yellow")
-           
-def process_patient(patient,outpath,size, interpolation, mask_interpolation, suffix, path_to_c3d,skip_files,include_files, verbose,log,NoSegmentation,AllSegmentation,use_c3d):           
+            # the files of all patients are listed first, then resampled one by one by the first free worker,
+            # so that a patient with many or large files does not keep a single worker busy at the end
+            with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(plan, resample, max(1, available_cores() // n_jobs), max(1, numba.config.NUMBA_NUM_THREADS // n_jobs), log)) as pool:
+                file_tasks = []
+                for patient_tasks in pool.imap_unordered(_run_plan, patients):
+                    file_tasks.extend(patient_tasks)
+                # largest files first (LPT scheduling), so that a few large files do not end up last and keep a single worker busy
+                file_tasks.sort(key=lambda file_task: _file_size(file_task[2]), reverse=True)
+                # files are handed out in batches, each worker reads the next file of its batch while resampling the current one
+                batch_size = max(1, len(file_tasks) // (4 * n_jobs))
+                batches = [file_tasks[i:i+batch_size] for i in range(0, len(file_tasks), batch_size)]
+                with tqdm(total=len(file_tasks),
+                          ncols=100,
+                          desc="NIFTI Spatial resampling",
+                          bar_format="{l_bar}{bar} [time left: {remaining}, time spent: {elapsed}]",
+                          colour="yellow") as progress_bar:
+                    for n_files in pool.imap_unordered(_run_resample, batches):
+                        progress_bar.update(n_files)
+
+_plan = None
+_resample = None
+
+def _file_size(path):
+    """Return the size on disk of a file, as an estimate of its resampling time (0 if it cannot be read)."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def _init_worker(plan, resample, n_threads, n_numba_threads, log):
+    """Pool initializer: keep the tasks of the worker, redirect stdout to the log file, share the ITK and Numba
+    threads between the workers and compile the kernels for the images (float32) and masks (int8) before the first task."""
+    global _plan, _resample
+    _plan = plan
+    _resample = resample
     if log != '':
-        f = open(log,'a+')
-        sys.stdout = f
+        # opened once per worker, line buffered so that messages of the workers are not interleaved mid-line
+        sys.stdout = open(log,'a+',buffering=1)
+    sitk.ProcessObject_SetGlobalDefaultNumberOfThreads(n_threads)
+    numba.set_num_threads(n_numba_threads)
+    # the source is a read-only view on the SimpleITK image buffer
+    for dtype, kernel in ((np.float32, _resample_linear), (np.int8, _resample_nearest)):
+        src = np.zeros((1, 1, 1), dtype=dtype)
+        src.flags.writeable = False
+        kernel(src, 1.0, 1.0, 1.0, np.zeros((1, 1, 1), dtype=dtype))
+
+def _run_plan(patient):
+    """List the files of a patient to resample, with the plan task set by _init_worker."""
+    return _plan(patient)
+
+def _run_resample(file_tasks):
+    """Resample a batch of files with the resample task set by _init_worker."""
+    return _resample(file_tasks)
+           
+def process_patient(patient,outpath,suffix,skip_files,include_files,verbose,NoSegmentation,AllSegmentation,skip_up_to_date=False):
+    """Create the output folders of a patient and return its files to resample, as
+    (patientID, subdirectory, input file, output file, is mask) tuples: the images then the masks of each subdirectory.
+    With skip_up_to_date, files whose output exists and is newer than the input are left out."""
     patientID=os.path.basename(patient)
+    file_tasks = []
     
     if len(include_files) > 0: #if file to include are specify
         if patientID not in include_files: #if patient is to be excluded
             if verbose:
                 print("\n"+patientID+" ("+patient+") is not in the list of patients to include",flush=True)
-            return 
+            return file_tasks
     
     if len(skip_files) > 0: #if there are files to skip
         if patientID in skip_files:
             if verbose:
                 print("\nskip "+patientID+" ("+patient+")",flush=True)
-            return
+            return file_tasks
     if verbose:
         hprint(f"Processing {patientID}", patient)
 
@@ -270,7 +339,7 @@ def process_patient(patient,outpath,size, interpolation, mask_interpolation, suf
     if not os.path.exists(os.path.join(outpath,patientID)):
         os.makedirs(os.path.join(outpath,patientID))
 
-    for patient_subdirectory in glob.glob(patient+"/*"):
+    for patient_subdirectory in list_subfolders(patient):
         subdirectory=os.path.basename(patient_subdirectory)
         if verbose:
             print(patientID+": "+subdirectory,flush=True)
@@ -279,67 +348,114 @@ def process_patient(patient,outpath,size, interpolation, mask_interpolation, suf
         if not os.path.exists(os.path.join(outpath,patientID,subdirectory)):
             os.makedirs(os.path.join(outpath,patientID,subdirectory))
                 
-        nifti_files = glob.glob(patient_subdirectory + "/*nii.gz")
+        nifti_files = glob.glob(os.path.join(glob.escape(patient_subdirectory), "*nii.gz"))
         if not nifti_files:
             print(f"\033[31mERROR! Empty directory for {patientID} {subdirectory}\033[0m ",flush=True)
         else:
-            for nifti_file in glob.glob(patient_subdirectory+"/*nii.gz"):
-                if not is_mask(nifti_file): # Skip if it's identified as a mask
-                    if verbose:
-                        hprint(f"Resampling Image {patientID} {subdirectory}", nifti_file)
-                    input_img= os.path.join(patient_subdirectory,nifti_file)
+            # each file is classified once, is_mask may have to read it
+            classified_files = [(nifti_file, is_mask(nifti_file)) for nifti_file in nifti_files]
+            for nifti_file, mask in classified_files:
+                if not mask: # Skip if it's identified as a mask
                     output_img=os.path.join(outpath,patientID,subdirectory,os.path.splitext(os.path.splitext(os.path.basename(nifti_file))[0])[0]+"_"+suffix+".nii.gz")
-
-                    if use_c3d:
-                        arg_img="-interpolation "+interpolation+" -resample-mm "+str(float(size))+"x"+str(float(size))+"x"+str(float(size))+"mm"
-                        arg_msk="-interpolation "+mask_interpolation+" -resample-mm "+str(float(size))+"x"+str(float(size))+"x"+str(float(size))+"mm"
-                    
-                        cmd = path_to_c3d+" "+input_img+ " " + arg_img + " -o " + output_img
-                        try:
-                            subprocess.run(shlex.split(cmd))
-                        except Exception as e:
-                            print("\033[31mERROR!\033[0m "+ cmd,flush=True)
-                            print(e)
-                    else:
-                        try:
-                            resample_image_sitk(input_img, output_img, size, interpolation,cast_type="float32")
-                        except:
-                            print("\033[31mERROR! Spatial resampling with sitk failed\033[0m", flush=True)
-                            print(f"\033[31mSkipping image for {patientID}{subdirectory}\033[0m",flush=True)
+                    if skip_up_to_date and _is_up_to_date(nifti_file, output_img):
+                        if verbose:
+                            hprint(f"Up to date Image {patientID} {subdirectory}", output_img)
+                        continue
+                    file_tasks.append((patientID, subdirectory, nifti_file, output_img, False))
            
-            if verbose:
-                print(patientID+": "+subdirectory+" masks",flush=True)
             if not NoSegmentation: #if there is mask to resample
-                for nifti_file in glob.glob(patient_subdirectory+"/*nii.gz"):
-                    if len(glob.glob(os.path.join(patient_subdirectory, "*nii.gz"))) > 1: #there is more than 1 nifti file
-                        if is_mask(nifti_file): #Nifti identified as a mask
-                            if verbose:
-                                hprint(f"Resampling Mask {patientID} {subdirectory}", nifti_file)
-
-                            input_msk= os.path.join(patient_subdirectory,nifti_file)
+                if len(nifti_files) > 1: #there is more than 1 nifti file
+                    for nifti_file, mask in classified_files:
+                        if mask: #Nifti identified as a mask
                             mask_name=os.path.splitext(os.path.splitext(os.path.basename(nifti_file))[0])[0]+"_"+suffix+".nii.gz"
                             output_msk=os.path.join(outpath,patientID,subdirectory,mask_name)
-                            if use_c3d:
-                                cmd = path_to_c3d+" "+ input_msk + " " + arg_msk + " -o " + output_msk
-                                try:
-                                    subprocess.run(shlex.split(cmd))
-                                except Exception as e:
-                                    print("\033[31mERROR!\033[0m "+cmd,flush=True)
-                                    print(e)
-                            else:
-                                try:
-                                    resample_image_sitk(input_msk, output_msk, size, mask_interpolation, cast_type="int8")
-                                except:
-                                    print("\033[31mERROR! Spatial resampling with sitk failed\033[0m", flush=True)
-                                    print(f"\033[31mSkipping image for {patientID}{subdirectory}\033[0m",flush=True)
+                            if skip_up_to_date and _is_up_to_date(nifti_file, output_msk):
+                                if verbose:
+                                    hprint(f"Up to date Mask {patientID} {subdirectory}", output_msk)
+                                continue
+                            file_tasks.append((patientID, subdirectory, nifti_file, output_msk, True))
+                else:
+                    if AllSegmentation: #all data need to be segemented
+                        print("\033[31mERROR!: No segmentation found in the current subdirectory\033[0m",flush=True)
+                        return file_tasks
                     else:
-                        if AllSegmentation: #all data need to be segemented
-                            print("\033[31mERROR!: No segmentation found in the current subdirectory\033[0m",flush=True)
-                            return
-                        else:
-                            print("\033[33mWARNING!: No segmentation found for data \033[0m"+patient_subdirectory,flush=True)
+                        print("\033[33mWARNING!: No segmentation found for data \033[0m"+patient_subdirectory,flush=True)
+    return file_tasks
+
+def _is_up_to_date(input_file, output_file):
+    """Return True if output_file exists, is not empty and is not older than input_file."""
+    try:
+        output_stat = os.stat(output_file)
+        return output_stat.st_size > 0 and output_stat.st_mtime >= os.stat(input_file).st_mtime
+    except OSError:
+        return False
+
+def resample_files(file_tasks,size,interpolation,mask_interpolation,path_to_c3d,verbose,use_c3d):
+    """Resample images and masks listed by process_patient, with c3d or SimpleITK. Return the number of files.
+    With SimpleITK, the next file is read and the previous one is written by two threads while the current one
+    is resampled (SimpleITK releases the GIL)."""
+    if use_c3d:
+        for file_task in file_tasks:
+            _resample_c3d(file_task,size,interpolation,mask_interpolation,path_to_c3d,verbose)
+        return len(file_tasks)
+
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+        def prefetch(file_task):
+            return reader.submit(read_image_sitk, file_task[2], "int8" if file_task[4] else "float32")
+
+        write = None
+        image_future = prefetch(file_tasks[0]) if len(file_tasks) > 0 else None
+        for n, (patientID, subdirectory, input_file, output_file, mask) in enumerate(file_tasks):
+            current_future = image_future
+            image_future = prefetch(file_tasks[n+1]) if n+1 < len(file_tasks) else None
+            if verbose:
+                hprint(f"Resampling {'Mask' if mask else 'Image'} {patientID} {subdirectory}", input_file)
+            try:
+                resampled_image = resample_sitk(current_future.result(), size, mask_interpolation if mask else interpolation)
+            except Exception:
+                print("\033[31mERROR! Spatial resampling with sitk failed\033[0m", flush=True)
+                print(f"\033[31mSkipping image for {patientID}{subdirectory}\033[0m",flush=True)
+                continue
+            finally:
+                # the input image is released as soon as it is resampled, not when the next one replaces it:
+                # the next input (being read) and the previous output (being written) are already in memory
+                del current_future
+            # at most one file is waiting to be written
+            _wait_write(write)
+            write = (writer.submit(sitk.WriteImage, resampled_image, output_file), patientID, subdirectory)
+        _wait_write(write)
+    return len(file_tasks)
+
+def _wait_write(write):
+    """Wait for a (future, patientID, subdirectory) write of resample_files, printing its error if it failed."""
+    if write is None:
+        return
+    future, patientID, subdirectory = write
+    try:
+        future.result()
+    except Exception:
+        print("\033[31mERROR! Spatial resampling with sitk failed\033[0m", flush=True)
+        print(f"\033[31mSkipping image for {patientID}{subdirectory}\033[0m",flush=True)
+
+def _resample_c3d(file_task,size,interpolation,mask_interpolation,path_to_c3d,verbose):
+    """Resample an image or a mask listed by process_patient with c3d."""
+    patientID, subdirectory, input_file, output_file, mask = file_task
+    if verbose:
+        hprint(f"Resampling {'Mask' if mask else 'Image'} {patientID} {subdirectory}", input_file)
+    # argument list passed as is: no shell string to split, paths with spaces are kept whole
+    cmd = [path_to_c3d, input_file, "-interpolation", mask_interpolation if mask else interpolation,
+           "-resample-mm", f"{float(size)}x{float(size)}x{float(size)}mm", "-o", output_file]
+    try:
+        subprocess.run(cmd)
+    except Exception as e:
+        print("\033[31mERROR!\033[0m "+ " ".join(cmd),flush=True)
+        print(e)
      
 
+#filename keywords of is_mask, each pattern searched in a single pass
+IMAGE_NAME = re.compile(r"img|image", re.IGNORECASE)
+MASK_NAME = re.compile(r"msk|mask", re.IGNORECASE)
+
 def is_mask(nifti_file, verbose=False):
     """
     Function to determine if a NIfTI file is a mask or an image based on the filename and the unique voxel intensities.
@@ -347,27 +463,34 @@ def is_mask(nifti_file, verbose=False):
     If verbose is True, it will print whether the file is identified as a mask or an image.
     """
     
-    # Check the filename for common patterns
-    filename = os.path.basename(nifti_file).lower()  # Convert to lowercase to avoid case sensitivity
+    # Check the filename for common patterns (case insensitive)
+    filename = os.path.basename(nifti_file)
     
-    if 'img' in filename or 'image' in filename:
+    if IMAGE_NAME.search(filename):
         if verbose:
             print(f"{nifti_file}: Identified as image based on filename.")
         return False  # Identified as an image
     
-    if 'msk' in filename or 'mask' in filename:
+    if MASK_NAME.search(filename):
         if verbose:
             print(f"{nifti_file}: Identified as mask based on filename.")
         return True  # Identified as a mask
     
     # If the filename doesn't give clear clues, check the voxel intensities
     img = nib.load(nifti_file)
-    data = img.get_fdata()
-    
-    unique_values = np.unique(data)
+    # The middle slice (of the first volume of 4D data) is read first, only the start of a .nii.gz file is
+    # decompressed: 100 unique values there are enough to identify an image. Otherwise the whole volume is read,
+    # in its stored dtype rather than as float64.
+    if len(img.shape) >= 3:
+        middle_slice = np.asanyarray(img.dataobj[(slice(None), slice(None), img.shape[2] // 2) + (0,) * (len(img.shape) - 3)])
+        if _n_unique(middle_slice) >= 100:
+            if verbose:
+                print(f"{nifti_file}: Identified as image based on unique values (more than 100 unique values).")
+            return False
+    data = np.asanyarray(img.dataobj)
     
     # Assume masks have few unique values, typically less than 10
-    if len(unique_values) < 100:
+    if _n_unique(data) < 100:
         if verbose:
             print(f"{nifti_file}: Identified as mask based on unique values (fewer than 100 unique values).")
         return True  # Consider it a mask
@@ -377,25 +500,62 @@ def is_mask(nifti_file, verbose=False):
         return False  # Consider it an image
 
 
+def _n_unique(data):
+    """Return the number of unique values of an array. Integer arrays with a small range of values are
+    counted with np.bincount in linear time, without the sort of np.unique."""
+    if data.size > 0 and data.dtype.kind in 'iu':
+        lo, hi = int(data.min()), int(data.max())
+        if hi - lo < 1 << 20:
+            # computed in intp, the type bincount works in: no overflow of small integer types ('K': no copy of Fortran-ordered NIfTI data)
+            counts = np.bincount(np.subtract(data.ravel('K'), lo, dtype=np.intp), minlength=hi - lo + 1)
+            return int(np.count_nonzero(counts))
+    return len(np.unique(data))
+
+
+#pixel types of the cast_type option of resample_image_sitk
+SITK_PIXEL_TYPES = {
+    "float32": sitk.sitkFloat32,
+    "int8": sitk.sitkInt8,
+    "int16": sitk.sitkInt16,
+    "uint8": sitk.sitkUInt8,
+    "uint16": sitk.sitkUInt16,
+}
+
+#interpolators of the interpolation_type option of resample_sitk
+SITK_INTERPOLATORS = {
+    "nearestneighbor": sitk.sitkNearestNeighbor,
+    "linear": sitk.sitkLinear,
+    "cubic": sitk.sitkBSpline,
+    "sinc": sitk.sitkHammingWindowedSinc,
+    "gaussian": sitk.sitkGaussian,
+    "b-spline": sitk.sitkBSpline,
+}
+
+_resampler = None
+
+def _get_resampler():
+    """Return the ResampleImageFilter of the process, created on first use. resample_sitk sets all its
+    parameters that change between images (size, spacing, origin, direction, interpolator) before each Execute."""
+    global _resampler
+    if _resampler is None:
+        _resampler = sitk.ResampleImageFilter()
+    return _resampler
+
 def resample_image_sitk(input_path, output_path, size, interpolation_type, cast_type=None):
-    # Load the image using SimpleITK
-    image = sitk.ReadImage(input_path)
+    # the input image is only referenced during the resampling, it is released before the output is written
+    resampled_image = resample_sitk(read_image_sitk(input_path, cast_type), size, interpolation_type)
+    # Save the resampled image
+    sitk.WriteImage(resampled_image, output_path)
 
-   # Optionally cast the image to the specified type
+def read_image_sitk(input_path, cast_type=None):
+    # Load the image using SimpleITK, optionally converted to the specified type while it is read (no second copy)
     if cast_type:
-        if cast_type.lower() == "float32":
-            image = sitk.Cast(image, sitk.sitkFloat32)
-        elif cast_type.lower() == "int8":
-            image = sitk.Cast(image, sitk.sitkInt8)
-        elif cast_type.lower() == "int16":
-            image = sitk.Cast(image, sitk.sitkInt16)
-        elif cast_type.lower() == "uint8":
-            image = sitk.Cast(image, sitk.sitkUInt8)
-        elif cast_type.lower() == "uint16":
-            image = sitk.Cast(image, sitk.sitkUInt16)
-        else:
+        if cast_type.lower() not in SITK_PIXEL_TYPES:
             raise ValueError(f"\033[31mERROR! Unsupported cast type: {cast_type}\033[0m")
+        return sitk.ReadImage(input_path, SITK_PIXEL_TYPES[cast_type.lower()])
+    return sitk.ReadImage(input_path)
 
+def resample_sitk(image, size, interpolation_type):
     # Define the new spacing and calculate the new size
     original_size = image.GetSize()
     original_spacing = image.GetSpacing()
@@ -406,34 +566,105 @@ def resample_image_sitk(input_path, output_path, size, interpolation_type, cast_
         int(round(original_size[2] * (original_spacing[2] / new_spacing[2])))
     ]
 
+    # Linear and nearest neighbor resampling of 3D scalar images run in a Numba kernel: the output grid has the
+    # origin and the direction of the input, so output voxel i samples input continuous index i * new/original spacing
+    kernel = _RESAMPLE_KERNELS.get(interpolation_type.lower())
+    if kernel is not None and image.GetDimension() == 3 and image.GetNumberOfComponentsPerPixel() == 1 \
+            and (kernel is _resample_nearest or image.GetPixelID() in (sitk.sitkFloat32, sitk.sitkFloat64)):
+        src = sitk.GetArrayViewFromImage(image) #indexed (z, y, x)
+        out = np.empty(new_size[::-1], dtype=src.dtype)
+        kernel(src, new_spacing[2] / original_spacing[2], new_spacing[1] / original_spacing[1], new_spacing[0] / original_spacing[0], out)
+        del src
+        # GetImageFromArray copies out into the image buffer, out is released on return
+        resampled_image = sitk.GetImageFromArray(out)
+        resampled_image.SetSpacing(new_spacing)
+        resampled_image.SetOrigin(image.GetOrigin())
+        resampled_image.SetDirection(image.GetDirection())
+        return resampled_image
+
+    # Choose interpolation type
+    if interpolation_type.lower() not in SITK_INTERPOLATORS:
+        raise ValueError(f"\033[31mERROR! Unsupported interpolation type: {interpolation_type}\033[0m")
+
     # Set the resampler
-    resampler = sitk.ResampleImageFilter()
+    resampler = _get_resampler()
     resampler.SetSize(new_size)
     resampler.SetOutputSpacing(new_spacing)
     resampler.SetOutputOrigin(image.GetOrigin())
     resampler.SetOutputDirection(image.GetDirection())
-
-    # Choose interpolation type
-    if interpolation_type.lower() == "nearestneighbor":
-        resampler.SetInterpolator(sitk.sitkNearestNeighbor)
-    elif interpolation_type.lower() == "linear":
-        resampler.SetInterpolator(sitk.sitkLinear)
-    elif interpolation_type.lower() == "cubic":
-        resampler.SetInterpolator(sitk.sitkBSpline)
-    elif interpolation_type.lower() == "sinc":
-        resampler.SetInterpolator(sitk.sitkHammingWindowedSinc)
-    elif interpolation_type.lower() == "gaussian":
-        resampler.SetInterpolator(sitk.sitkGaussian)
-    elif interpolation_type.lower() == "b-spline":
-        resampler.SetInterpolator(sitk.sitkBSpline)
-    else:
-        raise ValueError(f"\033[31mERROR! Unsupported interpolation type: {interpolation_type}033[0m")
+    resampler.SetInterpolator(SITK_INTERPOLATORS[interpolation_type.lower()])
 
     # Execute the resampling
-    resampled_image = resampler.Execute(image)
+    return resampler.Execute(image)
 
-    # Save the resampled image
-    sitk.WriteImage(resampled_image, output_path)
+# Kernels of resample_sitk, reproducing ResampleImageFilter with the Linear and NearestNeighbor interpolators:
+# a continuous index c of an axis of size n is inside the image when -0.5 <= c < n - 0.5 (0 is written outside),
+# linear interpolation clamps c to [0, n - 1] and nearest neighbor takes floor(c + 0.5).
+
+@numba.njit(parallel=True, cache=True)
+def _resample_linear(src, scale_z, scale_y, scale_x, out):
+    """Trilinear resampling of src (z, y, x) into out, output voxel (k, j, i) sampling src at (k*scale_z, j*scale_y, i*scale_x)."""
+    nz, ny, nx = src.shape
+    for k in numba.prange(out.shape[0]):
+        z = k * scale_z
+        if z < -0.5 or z >= nz - 0.5:
+            out[k] = 0
+            continue
+        z = min(max(z, 0.0), nz - 1.0)
+        z0 = int(z)
+        z1 = min(z0 + 1, nz - 1)
+        fz = z - z0
+        for j in range(out.shape[1]):
+            y = j * scale_y
+            if y < -0.5 or y >= ny - 0.5:
+                out[k, j] = 0
+                continue
+            y = min(max(y, 0.0), ny - 1.0)
+            y0 = int(y)
+            y1 = min(y0 + 1, ny - 1)
+            fy = y - y0
+            for i in range(out.shape[2]):
+                x = i * scale_x
+                if x < -0.5 or x >= nx - 0.5:
+                    out[k, j, i] = 0
+                    continue
+                x = min(max(x, 0.0), nx - 1.0)
+                x0 = int(x)
+                x1 = min(x0 + 1, nx - 1)
+                fx = x - x0
+                c00 = src[z0, y0, x0] * (1.0 - fx) + src[z0, y0, x1] * fx
+                c01 = src[z0, y1, x0] * (1.0 - fx) + src[z0, y1, x1] * fx
+                c10 = src[z1, y0, x0] * (1.0 - fx) + src[z1, y0, x1] * fx
+                c11 = src[z1, y1, x0] * (1.0 - fx) + src[z1, y1, x1] * fx
+                out[k, j, i] = (c00 * (1.0 - fy) + c01 * fy) * (1.0 - fz) + (c10 * (1.0 - fy) + c11 * fy) * fz
+
+@numba.njit(parallel=True, cache=True)
+def _resample_nearest(src, scale_z, scale_y, scale_x, out):
+    """Nearest neighbor resampling of src (z, y, x) into out, output voxel (k, j, i) sampling src at (k*scale_z, j*scale_y, i*scale_x)."""
+    nz, ny, nx = src.shape
+    for k in numba.prange(out.shape[0]):
+        z = k * scale_z
+        if z < -0.5 or z >= nz - 0.5:
+            out[k] = 0
+            continue
+        z0 = min(int(np.floor(z + 0.5)), nz - 1)
+        for j in range(out.shape[1]):
+            y = j * scale_y
+            if y < -0.5 or y >= ny - 0.5:
+                out[k, j] = 0
+                continue
+            y0 = min(int(np.floor(y + 0.5)), ny - 1)
+            for i in range(out.shape[2]):
+                x = i * scale_x
+                if x < -0.5 or x >= nx - 0.5:
+                    out[k, j, i] = 0
+                else:
+                    out[k, j, i] = src[z0, y0, min(int(np.floor(x + 0.5)), nx - 1)]
+
+_RESAMPLE_KERNELS = {"linear": _resample_linear, "nearestneighbor": _resample_nearest}
+
+# The kernels are compiled on first use, never at import, so that the main process does not start
+# Numba's threads before the Pool forks (see NiftiIntensityResampling).
 
 if __name__ == "__main__":
     main(sys.argv[1:])    
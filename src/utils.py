@@ -3,6 +3,9 @@
 
 import os,sys
 import re
+import importlib.util
+import shutil
+import subprocess
 
 #print in stderr
 def eprint(*args, **kwargs):
@@ -76,6 +79,80 @@ def hprint_msg_box(msg, indent=1, width=None, title=None):
 
 
 
+#list subfolders
+def list_subfolders(path):
+    """Return the paths of the non-hidden subfolders of path.
+       Uses a single os.scandir pass, the directory entries already tell which ones are folders."""
+    with os.scandir(path) as entries:
+        return [entry.path for entry in entries if entry.is_dir() and not entry.name.startswith('.')]
+
+
+#copy a file
+FICLONE = 0x40049409 #Linux ioctl sharing the data blocks of two files (btrfs, XFS, bcachefs)
+
+def copy_file(src, dst):
+    """Copy src to dst like shutil.copy, as a copy-on-write clone when the filesystem supports it.
+       Hard links are not used: a later step writing dst in place would also modify src."""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return dst
+    try:
+        import fcntl
+        with open(src,'rb') as fsrc, open(dst,'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copymode(src, dst)
+    except (ImportError, OSError): #not Linux, or no reflink support: plain copy (sendfile on Linux)
+        shutil.copy(src, dst)
+    return dst
+
+
+#save a NIfTI image
+PIGZ = shutil.which("pigz")
+
+def save_nifti(img, path, threads=2):
+    """Save a nibabel image like nib.save. When pigz is installed, .nii.gz files are compressed by pigz
+       on `threads` threads, at nibabel's compression level (1), instead of by zlib in the calling process."""
+    if PIGZ is None or not path.endswith(".gz") or not hasattr(img, "to_bytes"): #to_bytes: nibabel>=3
+        img.to_filename(path)
+        return
+    with open(path,'wb') as f:
+        subprocess.run([PIGZ, "-1", "-c", "-p", str(threads)], input=img.to_bytes(), stdout=f, check=True)
+
+
+#hint the kernel that a file will be read
+def advise_sequential_read(path):
+    """Tell the kernel that path will be read soon, from start to end, so that it starts reading it ahead
+       in the background. Does nothing where posix_fadvise is not available (macOS, Windows) or if path cannot be opened."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+#number of CPU cores available
+def available_cores():
+    """Return the number of CPU cores the process may run on.
+       Physical cores are counted when psutil is installed, so that hyperthreads are not oversubscribed."""
+    try:
+        n_cores = len(os.sched_getaffinity(0))
+    except AttributeError: #not available on macOS and Windows
+        n_cores = os.cpu_count() or 1
+    if importlib.util.find_spec("psutil") is not None:
+        import psutil
+        n_cores = min(n_cores, psutil.cpu_count(logical=False) or n_cores)
+    return n_cores
+
+
 def format_list_multiline(items, items_per_line=5):
     """Format a list into multiple lines with a comma at the end of each line except the last.
        Returns a single line if the list has fewer items than items_per_line."""  